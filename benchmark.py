@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import time
+from datetime import date, datetime
+
+from constants import USER_ACTIVE, USER_BLOCKED, DEFAULT_TZ_OFFSET
+from database import Database, reminder_minute
+
+# Замеры методов Database на синтетической базе:
+#   python benchmark.py --users 1000 10000 100000 --output results.json
+# Результаты сохраняются в JSON вместе с коммитом, чтобы сравнивать запуски
+
+# Доля заблокированных пользователей и распределение последнего выполнения:
+# (сколько дней назад, вероятность); None - ни разу не выполняли
+BLOCKED_SHARE = 0.1
+COMPLETION_AGES = [(0, 0.4), (1, 0.3), (3, 0.15), (None, 0.15)]
+CHALLENGE_DAYS = 75
+HISTORY_DAYS = 30
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def remove_db(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+# Синтетическая база: активный челлендж, пользователи со смешанными
+# статусами и датами выполнения, история выполнений за HISTORY_DAYS дней
+async def generate_population(db, users: int, seed: int):
+    rng = random.Random(seed)
+    today = date.today().toordinal()
+    start_day = today - HISTORY_DAYS
+
+    ages = [age for age, _ in COMPLETION_AGES]
+    weights = [weight for _, weight in COMPLETION_AGES]
+    rows, completions = [], []
+    for telegram_id in range(1, users + 1):
+        status = USER_BLOCKED if rng.random() < BLOCKED_SHARE else USER_ACTIVE
+        age = rng.choices(ages, weights)[0]
+        last_completion_day = today - age if age is not None else None
+        reminded = rng.random() < 0.5
+        rows.append((
+            telegram_id, f"user{telegram_id}", status, last_completion_day,
+            rng.randint(1, 3) if reminded else 0, today if reminded else None,
+            start_day, DEFAULT_TZ_OFFSET, reminder_minute(telegram_id, DEFAULT_TZ_OFFSET)
+        ))
+        if last_completion_day is not None:
+            for day in range(start_day, last_completion_day + 1):
+                if day == last_completion_day or rng.random() < 0.7:
+                    completions.append((telegram_id, day - start_day + 1, day))
+
+    async with db.pool.write() as conn:
+        await conn.execute(
+            '''INSERT INTO challenge_progress (challenge_name, challenge_task, total_days, start_day, current_day, is_active)
+            VALUES (?, ?, ?, ?, 1, TRUE)''',
+            ("Benchmark", "приседаний", CHALLENGE_DAYS, start_day)
+        )
+        async with conn.execute('SELECT last_insert_rowid()') as cursor:
+            challenge_id = (await cursor.fetchone())[0]
+        await conn.executemany(
+            '''INSERT INTO users (telegram_id, username, status, last_completion_day, reminder_count,
+                reminder_day, start_day, tz_offset, reminder_minute)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            rows
+        )
+        await conn.execute('UPDATE users SET challenge_id = ?', (challenge_id,))
+        await conn.executemany(
+            '''INSERT INTO completions (telegram_id, challenge_id, day_number, completion_day)
+            VALUES (?, ?, ?, ?)''',
+            [(telegram_id, challenge_id, day_number, day) for telegram_id, day_number, day in completions]
+        )
+    db.invalidate_challenge_cache()
+    await db.reconcile_stats()
+    # Строки записаны мимо Database - перечитываем кэш пользователей
+    if not db.shared:
+        await db.load_user_cache()
+    return [row[0] for row in rows if row[3] != today]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def measure(operation, iterations: int):
+    samples = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        call_started = time.perf_counter()
+        await operation(i)
+        samples.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return {
+        'iterations': iterations,
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'ops_per_sec': round(iterations / elapsed, 1) if elapsed else None,
+    }
+
+
+async def run_population(db_path: str, users: int, iterations: int, seed: int):
+    remove_db(db_path)
+    db = Database(db_path)
+    await db.init_db()
+    try:
+        generate_started = time.perf_counter()
+        pending = await generate_population(db, users, seed)
+        generate_seconds = time.perf_counter() - generate_started
+
+        # Полные выборки по всем пользователям дороже, их повторяем реже
+        full_scans = max(3, iterations // 10)
+        today = date.today()
+        rng = random.Random(seed)
+        sampled = rng.sample(pending, min(2 * iterations, len(pending)))
+        completing, completing_today = sampled[::2], sampled[1::2]
+
+        async def without_today_completion(i):
+            await db.get_users_without_today_completion()
+
+        challenge_ids = [challenge['id'] for challenge in await db.get_running_challenges()]
+
+        # Одна минута рассылки: пользователи одного слота окна напоминаний
+        async def reminder_tick(i):
+            minutes = [reminder_minute(i, DEFAULT_TZ_OFFSET)]
+            async for users_chunk in db.iter_users_without_today_completion(
+                reminder_minutes=minutes, challenge_ids=challenge_ids
+            ):
+                pass
+
+        # Бывший reset_daily_completions: смена дня теперь сводится к сбросу
+        # кэшей и очистке устаревших состояний FSM
+        async def midnight_rollover(i):
+            db.invalidate_challenge_cache()
+            await db.delete_expired_fsm_states()
+            await db.get_current_challenge()
+
+        async def completion(i):
+            await db.update_user_completion(completing[i], today, f"bench{i}")
+
+        async def complete(i):
+            await db.complete_today(completing_today[i], f"bench{i}", lambda day, challenge: [('text', f"{day}")])
+
+        async def all_users(i):
+            await db.get_all_users()
+
+        async def stats(i):
+            await db.get_stats()
+
+        async def user_lookup(i):
+            await db.get_user(completing[i % len(completing)])
+
+        async def timezone_change(i):
+            await db.set_user_timezone(completing[i % len(completing)], DEFAULT_TZ_OFFSET + 60 * (i % 3))
+
+        async def cohort_stats(i):
+            await db.get_cohort_stats(challenge_ids[0])
+
+        async def reconcile(i):
+            await db.reconcile_stats()
+
+        async def registration(i):
+            await db.add_user(users + 1 + i, f"new{i}")
+
+        benchmarks = [
+            ('get_users_without_today_completion', without_today_completion, full_scans),
+            ('reminder_tick', reminder_tick, iterations),
+            ('midnight_rollover', midnight_rollover, iterations),
+            ('update_user_completion', completion, len(completing)),
+            ('complete_today', complete, len(completing_today)),
+            ('get_all_users', all_users, full_scans),
+            ('get_stats', stats, iterations),
+            ('get_user', user_lookup, iterations),
+            ('set_user_timezone', timezone_change, iterations),
+            ('get_cohort_stats', cohort_stats, full_scans),
+            ('reconcile_stats', reconcile, full_scans),
+            ('add_user', registration, iterations),
+        ]
+        results = {}
+        for name, operation, count in benchmarks:
+            results[name] = await measure(operation, count)
+            logging.info(
+                f"{users} users, {name}: p50 {results[name]['p50_ms']} ms, "
+                f"p95 {results[name]['p95_ms']} ms, {results[name]['ops_per_sec']} ops/s"
+            )
+        return {'users': users, 'generate_seconds': round(generate_seconds, 2), 'benchmarks': results}
+    finally:
+        await db.close()
+        remove_db(db_path)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Замеры методов Database на синтетической базе")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000], help="размеры популяции")
+    parser.add_argument('--iterations', type=int, default=200, help="повторов на операцию")
+    parser.add_argument('--db-path', default='benchmark.db', help="временный файл базы (удаляется после замера)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="куда сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'iterations': args.iterations,
+        'seed': args.seed,
+        'runs': [],
+    }
+    for users in args.users:
+        report['runs'].append(await run_population(args.db_path, users, args.iterations, args.seed))
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        logging.info(f"Results saved to {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramForbiddenError, TelegramBadRequest
+)
+
+from metrics import broadcast_messages, broadcast_duration
+from constants import (
+    BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL, BROADCAST_MAX_RETRIES,
+    BROADCAST_JOURNAL_BATCH
+)
+
+# Ошибки Bad Request, после которых писать в чат бессмысленно
+PERMANENT_BAD_REQUEST_MARKERS = ('chat not found', 'user is deactivated', 'user not found')
+
+
+# Постоянная ошибка доставки: бот заблокирован (Forbidden), аккаунт удален
+# или чат не найден. Повторы не помогут, пользователь помечается недоступным
+def is_permanent_failure(error):
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        text = str(error).lower()
+        return any(marker in text for marker in PERMANENT_BAD_REQUEST_MARKERS)
+    return False
+
+
+# Глобальный ограничитель скорости: ведро на rate токенов в секунду
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        # Ведро меньше одного токена никогда не наполнится до отправки
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # После RetryAfter никто не отправляет, пока не истечет пауза
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Ограничение частоты сообщений в один чат
+class ChatLimiter:
+    # При каком размере чистить устаревшие записи
+    PRUNE_SIZE = 10000
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_allowed = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        if len(self._next_allowed) >= self.PRUNE_SIZE:
+            self._next_allowed = {k: v for k, v in self._next_allowed.items() if v > now}
+
+        allowed_at = self._next_allowed.get(chat_id, 0.0)
+        self._next_allowed[chat_id] = max(now, allowed_at) + self.interval
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+
+# Счетчики одного запуска рассылки
+class BroadcastStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        state = "cancelled" if self.cancelled else "finished"
+        return (
+            f"Broadcast '{self.name}' {state}: sent {self.sent}/{self.total}, "
+            f"failed {self.failed}, retries {self.retries}, "
+            f"{self.elapsed:.1f}s, {self.throughput:.1f} msg/s"
+        )
+
+
+async def _iterate(messages):
+    if hasattr(messages, '__aiter__'):
+        async for item in messages:
+            yield item
+    else:
+        for item in messages:
+            yield item
+
+
+# Массовая рассылка с ограничением параллельности и скорости.
+# messages - (асинхронный) итератор пар (chat_id, data), send(chat_id, data)
+# отправляет одно сообщение, on_result(chat_id, data, error) вызывается после
+# каждой попытки доставки (error is None при успехе).
+class Broadcaster:
+    def __init__(
+        self,
+        bot,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        rate: float = BROADCAST_RATE,
+        per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL,
+        max_retries: int = BROADCAST_MAX_RETRIES
+    ):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = ChatLimiter(per_chat_interval)
+        self._runs = set()
+
+    async def run(self, name: str, messages, send, on_result=None):
+        stats = BroadcastStats(name)
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [
+            asyncio.create_task(self._worker(queue, send, on_result, stats))
+            for _ in range(self.concurrency)
+        ]
+        run_task = asyncio.current_task()
+        self._runs.add(run_task)
+
+        try:
+            async for chat_id, data in _iterate(messages):
+                stats.total += 1
+                await queue.put((chat_id, data))
+            await queue.join()
+        except asyncio.CancelledError:
+            stats.cancelled = True
+            raise
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # Закрываем генератор получателей, чтобы он освободил соединение с БД
+            if hasattr(messages, 'aclose'):
+                await messages.aclose()
+            self._runs.discard(run_task)
+            stats.finished = time.monotonic()
+            broadcast_duration.observe((name,), stats.elapsed)
+            logging.info(str(stats))
+
+        return stats
+
+    async def shutdown(self):
+        # Останавливаем незавершенные рассылки при остановке планировщика
+        runs = list(self._runs)
+        for run_task in runs:
+            run_task.cancel()
+        await asyncio.gather(*runs, return_exceptions=True)
+
+    async def _worker(self, queue, send, on_result, stats):
+        while True:
+            chat_id, data = await queue.get()
+            try:
+                error = None
+                try:
+                    await self._deliver(chat_id, data, send, stats)
+                    stats.sent += 1
+                    broadcast_messages.inc((stats.name, 'sent'))
+                except Exception as e:
+                    error = e
+                    stats.failed += 1
+                    broadcast_messages.inc((stats.name, 'failed'))
+                    logging.error(f"Failed to send {stats.name} to {chat_id}: {e}")
+
+                if on_result:
+                    await on_result(chat_id, data, error)
+            except Exception as e:
+                logging.error(f"Error handling {stats.name} result for {chat_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, chat_id, data, send, stats):
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            await self.chat_limiter.wait(chat_id)
+            try:
+                return await send(chat_id, data)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f"Flood control on {chat_id}, retry after {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f"Temporary error sending to {chat_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+            attempt += 1
+            stats.retries += 1
+            broadcast_messages.inc((stats.name, 'retried'))
+
+
+# Журнал доставки одного запуска рассылки (строка broadcast_jobs).
+# Получатели попадают в журнал со статусом pending до отправки, результаты
+# копятся в памяти и записываются пачками. Запуск, прерванный перезапуском,
+# остается незавершенным: досылаются pending-получатели, а выборка
+# продолжается по сохраненным params. При сбое повторно могут уйти
+# не больше batch_size последних сообщений. Получатели с постоянной
+# ошибкой доставки помечаются недоступными той же пачкой
+class BroadcastJournal:
+    def __init__(
+        self, db, name: str, params=None, job_id: int = None,
+        batch_size: int = BROADCAST_JOURNAL_BATCH, reminder_tick: int = None
+    ):
+        self.db = db
+        self.name = name
+        self.params = params
+        self.job_id = job_id
+        self.reminder_tick = reminder_tick
+        self.batch_size = batch_size
+        self._results = []
+        self._unreachable = []
+        self.unreachable = 0
+
+    async def start(self):
+        # Запуск создается при первой пачке, чтобы пустые тики не попадали в журнал
+        if self.job_id is None:
+            self.job_id = await self.db.create_broadcast_job(self.name, self.params, self.reminder_tick)
+        return self.job_id
+
+    async def record(self, chat_id, data, error):
+        self._results.append((chat_id, None if error is None else str(error)[:500]))
+        if error is not None and is_permanent_failure(error):
+            self._unreachable.append(chat_id)
+        if len(self._results) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._results or self.job_id is None:
+            return
+        results, self._results = self._results, []
+        unreachable, self._unreachable = self._unreachable, []
+        try:
+            await self.db.record_broadcast_results(self.job_id, results)
+            if unreachable:
+                self.unreachable += await self.db.mark_users_unreachable(unreachable)
+        except Exception as e:
+            # Результаты остаются в памяти до следующей записи: иначе досылка
+            # отправила бы этим получателям напоминание повторно
+            self._results = results + self._results
+            self._unreachable = unreachable + self._unreachable
+            logging.error(f"Error saving {self.name} journal ({len(results)} results): {e}")
+
+    async def run(self, broadcaster, messages, send):
+        completed = False
+        try:
+            stats = await broadcaster.run(self.name, messages, send, self.record)
+            completed = True
+            return stats
+        finally:
+            await self.flush()
+            if self.unreachable:
+                logging.info(f"Broadcast '{self.name}': {self.unreachable} users marked unreachable")
+            if completed and self.job_id is not None:
+                await self.db.finish_broadcast_job(self.job_id)
@@ -10,10 +10,134 @@ DEFAULT_CHALLENGE_DAYS = 75
 UPDATE_HOUR = 0
 UPDATE_MINUTE = 0
 
-# Время напоминаний (8:00 и 18:00 по МСК)
+# Время напоминаний по местному времени пользователя. Напоминания
+# растянуты на REMINDER_WINDOW_MINUTES минут после каждого времени:
+# у каждого пользователя своя минута внутри окна (после изменения окна
+# минуты пересчитываются при запуске)
 REMINDER_TIMES = [(7, 0),(15, 0), (19, 0)]
+REMINDER_WINDOW_MINUTES = 60
+
+# Часовой пояс по умолчанию (смещение от UTC в минутах, МСК = +3:00)
+# и допустимый диапазон для /timezone. День челленджа меняется в
+# UPDATE_HOUR:UPDATE_MINUTE по МСК, поэтому все напоминания по местному
+# времени должны попадать в один день по МСК: при текущих настройках
+# это пояса от UTC-1:00 до UTC+10:00
+MSK_TZ_OFFSET = 180
+DEFAULT_TZ_OFFSET = MSK_TZ_OFFSET
+_DAY_START = UPDATE_HOUR * 60 + UPDATE_MINUTE
+MIN_TZ_OFFSET = (
+    max(hour * 60 + minute for hour, minute in REMINDER_TIMES) + REMINDER_WINDOW_MINUTES
+    + MSK_TZ_OFFSET - _DAY_START - 24 * 60
+)
+MAX_TZ_OFFSET = min(hour * 60 + minute for hour, minute in REMINDER_TIMES) + MSK_TZ_OFFSET - _DAY_START
+
+# Получение обновлений: long polling (False) или webhook (True).
+# WEBHOOK_BASE_URL - публичный https-адрес бота; если пуст, webhook не
+# регистрируется в Telegram и сервер можно проверять локально
+USE_WEBHOOK = False
+WEBHOOK_BASE_URL = ''
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = ''
+WEB_SERVER_HOST = '0.0.0.0'
+WEB_SERVER_PORT = 8080
+
+# Количество процессов-обработчиков обновлений. Больше одного - только
+# с USE_WEBHOOK: процессы слушают один порт (SO_REUSEPORT), а планировщик и
+# публикация в канал работают только в первом из них
+WORKERS = 1
+# Несколько процессов реально запускаются только в этом случае: без webhook
+# бот работает одним процессом, и кэши в памяти остаются точными
+MULTI_PROCESS = WORKERS > 1 and USE_WEBHOOK
+
+# Кэш пользователей в памяти (только при одном процессе): как часто
+# записывать в БД отложенные изменения - часовой пояс и username (сек)
+USER_CACHE_FLUSH_SECONDS = 30
+
+# Сколько живут кэши в памяти процесса, когда процессов несколько (сек):
+# изменения, сделанные другим процессом, видны не позже чем через это время
+SHARED_CACHE_TTL = 60
+
+# HTTP-сервер метрик Prometheus (/metrics); процесс N слушает METRICS_PORT + N.
+# 0 - не запускать. 9100 не используем: это порт node_exporter
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9181
+
+# Сколько хранится незавершенный диалог (состояние FSM) без активности (сек)
+FSM_STATE_TTL = 24 * 60 * 60
+
+# Пользователей на странице списка: строка занимает до ~130 символов,
+# так что страница гарантированно помещается в одно сообщение (4096)
+USERS_PAGE_SIZE = 25
+
+# Массовая блокировка/активация: максимум ID за раз, размер файла со
+# списком (байт) и сколько ненайденных ID перечислять в ответе
+BULK_STATUS_MAX_IDS = 10000
+BULK_STATUS_MAX_FILE_SIZE = 1024 * 1024
+BULK_UNKNOWN_IDS_SHOWN = 20
+
+# Выгрузка в CSV: строк за одно чтение из БД и размер файла (байт),
+# начиная с которого он сжимается в gzip
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_GZIP_THRESHOLD = 5 * 1024 * 1024
+
+# Очередь публикаций в канал: скорость (сообщений в минуту), число попыток
+# при неизвестных ошибках, наибольшая пауза между повторами (сек) и как часто
+# проверять очередь, если новых публикаций нет (сек). Сетевые ошибки и ошибки
+# сервера Telegram повторяются без ограничения числа попыток
+CHANNEL_POSTS_PER_MINUTE = 20
+CHANNEL_QUEUE_MAX_ATTEMPTS = 8
+CHANNEL_QUEUE_MAX_DELAY = 300
+CHANNEL_QUEUE_POLL_INTERVAL = 30
+
+# Дайджест канала: вместо сообщения на каждое выполнение - одна сводка раз
+# в CHANNEL_DIGEST_INTERVAL_MINUTES минут или по CHANNEL_DIGEST_MAX_COMPLETIONS
+# выполнениям. Режим по умолчанию, админ переключает его в "Управление челленджем".
+# CHANNEL_DIGEST_GROUP_VIDEO_NOTES - кружочки тоже копятся и уходят пачкой
+# перед сводкой (в альбом кружочки Telegram не объединяет)
+CHANNEL_DIGEST_MODE = False
+CHANNEL_DIGEST_INTERVAL_MINUTES = 30
+CHANNEL_DIGEST_MAX_COMPLETIONS = 50
+CHANNEL_DIGEST_GROUP_VIDEO_NOTES = False
+
+# Максимальная длина текстового сообщения Telegram
+MESSAGE_MAX_LENGTH = 4096
+
+# Таблица лидеров по сериям: время ежедневной публикации в канал (МСК) и размер
+LEADERBOARD_TIME = (22, 0)
+LEADERBOARD_SIZE = 10
+
+# Как часто сверять счетчики статистики с таблицей пользователей (минуты)
+STATS_RECONCILE_MINUTES = 60
+
+# База данных: путь к файлу и количество соединений-читателей
+DB_PATH = 'bot.db'
+DB_READERS = 4
+
+# Сколько строк за раз читать из БД при рассылке напоминаний
+REMINDER_CHUNK_SIZE = 500
+
+# Рассылки: параллельность, общий лимит Telegram (~30 сообщений/сек),
+# минимальный интервал между сообщениями в один чат и число повторов
+BROADCAST_CONCURRENCY = 20
+BROADCAST_RATE = 30
+BROADCAST_PER_CHAT_INTERVAL = 1.0
+BROADCAST_MAX_RETRIES = 3
+
+# Журнал рассылок: сколько результатов доставки копить перед записью в БД
+# и сколько дней хранить завершенные рассылки
+BROADCAST_JOURNAL_BATCH = 100
+BROADCAST_JOURNAL_KEEP_DAYS = 7
+
+# Кэш проверки подписки на канал: размер и время жизни (сек) для
+# подписанных и неподписанных пользователей
+SUBSCRIPTION_CACHE_SIZE = 50000
+SUBSCRIPTION_CACHE_TTL = 6 * 60 * 60
+SUBSCRIPTION_NEGATIVE_CACHE_TTL = 60
 
 # Состояния пользователя
 USER_ACTIVE = "active"
 USER_BLOCKED = "blocked"
+# Бот заблокирован пользователем или аккаунт удален: выставляется по ошибкам
+# отправки и снимается, когда пользователь снова пишет боту
+USER_UNREACHABLE = "unreachable"
 #8424935624:AAFSiryRzrfZOVwlcKpTszbSQAlB_7D6fP4
\ No newline at end of file
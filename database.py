@@ -1,95 +1,515 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
 import aiosqlite
-from datetime import datetime, date, timedelta
-from constants import USER_ACTIVE
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+from migrations import apply_migrations
+from metrics import instrument_class, record_db_access, record_rows_touched
+from constants import (
+    USER_ACTIVE, USER_BLOCKED, USER_UNREACHABLE, DB_PATH, DB_READERS, REMINDER_CHUNK_SIZE, LEADERBOARD_SIZE, USERS_PAGE_SIZE,
+    MULTI_PROCESS, SHARED_CACHE_TTL, DEFAULT_TZ_OFFSET, MIN_TZ_OFFSET, MAX_TZ_OFFSET, REMINDER_WINDOW_MINUTES, EXPORT_CHUNK_SIZE, CHANNEL_DIGEST_MODE
+)
+
+# Настройки каждого соединения: WAL не дает читателям блокировать запись,
+# synchronous=NORMAL в режиме WAL не делает fsync на каждый коммит
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+)
+
+# Размер кэша подготовленных выражений sqlite3 на одно соединение
+STATEMENT_CACHE_SIZE = 256
+
+# UPDATE ... RETURNING появился в SQLite 3.35
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+# Долгоживущие соединения с БД: один писатель и небольшой пул читателей
+class ConnectionPool:
+    def __init__(self, db_path, readers=DB_READERS):
+        self.db_path = db_path
+        self.readers = readers
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._connections = []
+
+    @property
+    def is_open(self):
+        return self._writer is not None
+
+    async def _connect(self, readonly=False):
+        conn = await aiosqlite.connect(self.db_path, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute('PRAGMA query_only = ON')
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        if self.is_open:
+            return
+        # Писатель открывается первым, чтобы переключить файл в режим WAL
+        self._writer = await self._connect()
+        for _ in range(self.readers):
+            self._readers.put_nowait(await self._connect(readonly=True))
+
+    async def close(self):
+        connections, self._connections = self._connections, []
+        self._writer = None
+        self._readers = asyncio.Queue()
+        for conn in connections:
+            await conn.close()
+
+    @asynccontextmanager
+    async def write(self):
+        # Одна транзакция записи за раз: коммит при успехе, откат при ошибке.
+        # BEGIN IMMEDIATE сразу берет блокировку записи файла, чтобы транзакции
+        # "чтение, затем запись" из разных процессов ждали друг друга
+        # (busy_timeout), а не падали с SQLITE_BUSY
+        record_db_access()
+        async with self._write_lock:
+            changes_before = self._writer.total_changes
+            await self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+                # Строки, измененные транзакцией, - для метрики bot_db_rows_total
+                record_rows_touched(self._writer.total_changes - changes_before)
+
+    @asynccontextmanager
+    async def read(self):
+        record_db_access()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+
+# Текущий день пользователя в SQL (та же формула, что и challenge_day);
+# ожидает таблицы users u и поток пользователя c из CHALLENGE_JOIN
+CURRENT_DAY_SQL = '''CASE
+    WHEN u.start_day IS NULL OR c.total_days IS NULL THEN 1
+    WHEN :today < u.start_day THEN 0
+    ELSE MIN(:today - u.start_day + 1, c.total_days)
+END'''
+
+# Завершенный поток не присоединяется - как будто челленджа нет
+CHALLENGE_JOIN = '''LEFT JOIN challenge_progress c
+    ON c.id = u.challenge_id AND c.is_active = TRUE'''
+
+# Счетчик напоминаний относится к дню reminder_day, в другие дни он равен 0,
+# поэтому ночной сброс не нужен
+REMINDER_COUNT_SQL = 'CASE WHEN u.reminder_day = :today THEN u.reminder_count ELSE 0 END'
+REMINDER_INCREMENT_SQL = '''reminder_count = CASE WHEN reminder_day = :today THEN reminder_count + 1 ELSE 1 END,
+    reminder_day = :today'''
+
+
+# Счетчики статистики: (имя, день) -> значение; день 0 - общие счетчики,
+# иначе date.toordinal() дня, к которому относится счетчик
+STAT_USERS = 'users'
+STAT_COMPLETED = 'completed'
+STAT_REMINDED = 'reminded'
+STAT_UNREACHABLE = 'became_unreachable'
+
+# Ключи admin_settings: id основного потока, режим дайджеста канала ('1'/'0')
+# и последняя обработанная минута напоминаний (минуты UTC с начала эпохи)
+SETTING_DEFAULT_CHALLENGE = 'default_challenge_id'
+SETTING_CHANNEL_DIGEST = 'channel_digest'
+SETTING_REMINDER_TICK = 'reminder_last_minute'
+SETTING_REMINDER_WINDOW = 'reminder_window_minutes'
+
+# Результаты complete_today
+COMPLETION_DONE = 'done'
+COMPLETION_ALREADY_DONE = 'already_done'
+COMPLETION_NOT_STARTED = 'not_started'
+COMPLETION_BLOCKED = 'blocked'
+COMPLETION_NOT_REGISTERED = 'not_registered'
+
+# Статусы записей в channel_queue
+QUEUE_PENDING = 'pending'
+QUEUE_FAILED = 'failed'
+
+# Журнал рассылок: статусы запуска и доставки отдельному получателю
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_EXPIRED = 'expired'
+DELIVERY_PENDING = 'pending'
+DELIVERY_SENT = 'sent'
+DELIVERY_FAILED = 'failed'
+
+
+# Колонки users в порядке SELECT *: хендлеры обращаются к строке по индексу
+USER_COLUMNS = (
+    'telegram_id', 'username', 'status', 'last_completion_day', 'reminder_count', 'created_at',
+    'start_day', 'current_day', 'reminder_day', 'tz_offset', 'reminder_minute', 'challenge_id', 'unreachable_day'
+)
+# Колонки, изменения которых кэш пишет в БД отложенно, пачками
+USER_DEFERRED_COLUMNS = ('username', 'tz_offset', 'reminder_minute')
+USER_SELECT = ', '.join(USER_COLUMNS)
+
+
+# Строка users в кэше: __slots__ вместо словаря атрибутов экономит память
+# на каждой записи. dirty - есть отложенные изменения, еще не записанные в БД
+class UserRecord:
+    __slots__ = USER_COLUMNS + ('dirty',)
+
+    def __init__(self, row):
+        for name, value in zip(USER_COLUMNS, row):
+            setattr(self, name, value)
+        self.dirty = False
+
+    def update(self, row):
+        # Строка из БД не затирает отложенные изменения
+        for name, value in zip(USER_COLUMNS, row):
+            if not (self.dirty and name in USER_DEFERRED_COLUMNS):
+                setattr(self, name, value)
+
+    def as_row(self):
+        return tuple(getattr(self, name) for name in USER_COLUMNS)
+
+
+def status_counter(status: str):
+    return f'status:{status}'
+
+
+def challenge_day(start_day: int, total_days: int, today: int):
+    # 0 - челлендж еще не начался, дальше не больше total_days
+    if today < start_day:
+        return 0
+    return min(today - start_day + 1, total_days)
+
+
+def reminder_minute(telegram_id: int, tz_offset: int):
+    # Минута суток по UTC, сдвинутая относительно времени напоминания:
+    # пользователи равномерно распределены по окну REMINDER_WINDOW_MINUTES,
+    # а местное время переведено в UTC
+    return (telegram_id % REMINDER_WINDOW_MINUTES - tz_offset) % 1440
+
 
 class Database:
-    def __init__(self, db_path='bot.db'):
+    def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path)
+        
+        # Кэш активных потоков (id -> строка) и основного потока: меняются
+        # только методами управления челленджами
+        self._challenges = {}
+        self._default_challenge_id = None
+        self._challenge_cached = False
+        self._challenge_generation = 0
+        self._challenge_cached_at = 0.0
+        self.challenge_cache_hits = 0
+        self.challenge_cache_misses = 0
+        
+        # Режим сводки канала (None - еще не прочитан); меняется только
+        # set_channel_digest_mode
+        self._channel_digest = None
+        self._channel_digest_at = 0.0
+        
+        # Копия таблицы stats_counters в памяти для панели статистики
+        self._stats = {}
+        
+        # Несколько процессов пишут в одну БД: кэш челленджа живет
+        # ограниченное время, а статистика читается из таблицы
+        self.shared = MULTI_PROCESS
+        
+        # Кэш пользователей (telegram_id -> UserRecord) загружается при запуске.
+        # Все изменения users идут через этот объект, поэтому кэш точен;
+        # при нескольких процессах он выключен (None)
+        self._users = None
+        self._dirty_users = set()
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    telegram_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    status TEXT DEFAULT 'active',
-                    last_completion_date DATE,
-                    reminder_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    start_date DATE,
-                    current_day INTEGER DEFAULT 0
-                )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS admin_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS challenge_progress (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    challenge_name TEXT,
-                    challenge_task TEXT,
-                    total_days INTEGER,
-                    start_date DATE,
-                    current_day INTEGER DEFAULT 1,
-                    is_active BOOLEAN DEFAULT TRUE
-                )
-            ''')
-            
-            await db.commit()
+        await self.pool.open()
+        await apply_migrations(self.pool)
+        await self.sync_reminder_window()
+        # Сверка заодно загружает счетчики в память
+        await self.reconcile_stats()
+        if not self.shared:
+            await self.load_user_cache()
 
-    async def add_user(self, telegram_id: int, username: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем текущий активный челлендж
-            current_challenge = await self.get_current_challenge()
-            start_date = date.today() if current_challenge else None
-            
+    async def sync_reminder_window(self):
+        # reminder_minute зависит от REMINDER_WINDOW_MINUTES: если окно в
+        # настройках изменилось, пересчитываем минуты всех пользователей.
+        # Пояса вне MIN_TZ_OFFSET..MAX_TZ_OFFSET (сохраненные до ограничения
+        # или до изменения настроек) сдвигаются к ближайшей границе
+        async with self.pool.write() as db:
+            async with db.execute(
+                'SELECT value FROM admin_settings WHERE key = ?', (SETTING_REMINDER_WINDOW,)
+            ) as cursor:
+                setting = await cursor.fetchone()
+            async with db.execute(
+                '''UPDATE users SET tz_offset = MIN(MAX(tz_offset, :min_offset), :max_offset)
+                WHERE tz_offset NOT BETWEEN :min_offset AND :max_offset''',
+                {'min_offset': MIN_TZ_OFFSET, 'max_offset': MAX_TZ_OFFSET}
+            ) as cursor:
+                clamped = cursor.rowcount
+            if setting and int(setting[0]) == REMINDER_WINDOW_MINUTES and not clamped:
+                return
             await db.execute(
-                'INSERT OR IGNORE INTO users (telegram_id, username, start_date, current_day) VALUES (?, ?, ?, ?)',
-                (telegram_id, username, start_date, 1)
+                'UPDATE users SET reminder_minute = (telegram_id % ? - tz_offset + 1440) % 1440',
+                (REMINDER_WINDOW_MINUTES,)
             )
-            await db.commit()
+            await self._set_setting(db, SETTING_REMINDER_WINDOW, REMINDER_WINDOW_MINUTES)
+        logging.info(
+            f"Reminder minutes recalculated for a {REMINDER_WINDOW_MINUTES}-minute window, "
+            f"time zones moved into range: {clamped}"
+        )
+
+    async def close(self):
+        if self.pool.is_open:
+            try:
+                await self.flush_users()
+            except Exception as e:
+                logging.error(f"Failed to flush user cache: {e}")
+        await self.pool.close()
+
+    async def load_user_cache(self):
+        # Полная загрузка users; отложенные изменения сначала записываются
+        await self.flush_users()
+        async with self.pool.read() as db:
+            async with db.execute(f'SELECT {USER_SELECT} FROM users') as cursor:
+                self._users = {row[0]: UserRecord(row) for row in await cursor.fetchall()}
+        logging.info(f"User cache loaded: {len(self._users)} users")
+
+    # Строки пользователей, измененные транзакцией: читаются в ней же,
+    # а в кэш попадают только после коммита (как и счетчики статистики)
+    async def _read_users(self, db, telegram_ids):
+        if self._users is None or not telegram_ids:
+            return []
+        async with db.execute(
+            f'SELECT {USER_SELECT} FROM users WHERE telegram_id IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(telegram_ids)),)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    def _apply_users(self, rows):
+        if self._users is None:
+            return
+        for row in rows:
+            record = self._users.get(row[0])
+            if record is None:
+                self._users[row[0]] = UserRecord(row)
+            else:
+                record.update(row)
+
+    def _defer_user_update(self, record, **values):
+        for name, value in values.items():
+            setattr(record, name, value)
+        record.dirty = True
+        self._dirty_users.add(record.telegram_id)
+
+    async def flush_users(self):
+        # Отложенные изменения кэша одной транзакцией; возвращает число строк
+        if not self._dirty_users:
+            return 0
+        dirty, self._dirty_users = self._dirty_users, set()
+        snapshot = {}
+        for telegram_id in dirty:
+            record = self._users.get(telegram_id)
+            if record:
+                snapshot[telegram_id] = (record.username, record.tz_offset, record.reminder_minute)
+        
+        try:
+            async with self.pool.write() as db:
+                await db.executemany(
+                    'UPDATE users SET username = ?, tz_offset = ?, reminder_minute = ? WHERE telegram_id = ?',
+                    [values + (telegram_id,) for telegram_id, values in snapshot.items()]
+                )
+        except Exception:
+            self._dirty_users |= dirty
+            raise
+        
+        # Изменившиеся во время записи строки остаются в очереди
+        for telegram_id in snapshot:
+            if telegram_id not in self._dirty_users:
+                self._users[telegram_id].dirty = False
+        return len(snapshot)
+
+    def invalidate_challenge_cache(self):
+        self._challenge_cached = False
+        self._challenges = {}
+        self._default_challenge_id = None
+        self._challenge_generation += 1
+
+    async def add_user(self, telegram_id: int, username: str):
+        # Новый участник записывается в основной поток
+        challenge = await self.get_current_challenge()
+        challenge_id = challenge[4] if challenge else None
+        start_day = max(challenge[3], date.today().toordinal()) if challenge else None
+        
+        changes = {}
+        async with self.pool.write() as db:
+            async with db.execute(
+                '''INSERT OR IGNORE INTO users
+                (telegram_id, username, start_day, current_day, tz_offset, reminder_minute, challenge_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (telegram_id, username, start_day, 1, DEFAULT_TZ_OFFSET, reminder_minute(telegram_id, DEFAULT_TZ_OFFSET), challenge_id)
+            ) as cursor:
+                if cursor.rowcount == 1:
+                    changes = {(STAT_USERS, 0): 1, (status_counter(USER_ACTIVE), 0): 1}
+            if changes and challenge_id:
+                await db.execute(
+                    'INSERT OR REPLACE INTO challenge_enrollments (challenge_id, telegram_id, start_day) VALUES (?, ?, ?)',
+                    (challenge_id, telegram_id, start_day)
+                )
+            await self._change_counters(db, changes)
+            users = await self._read_users(db, [telegram_id] if changes else [])
+        self._apply_counters(changes)
+        self._apply_users(users)
 
     async def get_user(self, telegram_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        if self._users is not None:
+            record = self._users.get(telegram_id)
+            return record.as_row() if record else None
+        
+        async with self.pool.read() as db:
             async with db.execute(
                 'SELECT * FROM users WHERE telegram_id = ?', 
                 (telegram_id,)
             ) as cursor:
                 return await cursor.fetchone()
 
-    async def update_user_completion(self, telegram_id: int, completion_date: date):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем текущий день челленджа для пользователя
-            user = await self.get_user(telegram_id)
-            if user and user[6]:  # start_date
-                start_date = datetime.strptime(user[6], '%Y-%m-%d').date()
-                days_since_start = (completion_date - start_date).days
-                current_day = days_since_start + 1
+    async def update_user_completion(self, telegram_id: int, completion_date: date, file_unique_id: str = None):
+        completion_day = completion_date.toordinal()
+        current_day = None
+        
+        async with self.pool.write() as db:
+            # Прежнее состояние читаем в той же транзакции, чтобы счетчики сошлись
+            async with db.execute(
+                'SELECT status, start_day, last_completion_day, reminder_day, reminder_count, challenge_id FROM users WHERE telegram_id = ?',
+                (telegram_id,)
+            ) as cursor:
+                user = await cursor.fetchone()
+            if not user:
+                return
+            status, start_day, last_completion_day, reminder_day, reminder_count, challenge_id = user
+            
+            # Выполнившие сегодня считаются только среди активных, как в get_cohort_stats
+            changes = {}
+            if last_completion_day != completion_day and status == USER_ACTIVE:
+                changes[(STAT_COMPLETED, completion_day)] = 1
+            if reminder_day == completion_day and reminder_count > 0:
+                changes[(STAT_REMINDED, completion_day)] = -1
+            await self._change_counters(db, changes)
+            
+            if start_day:
+                current_day = completion_day - start_day + 1
                 
                 await db.execute(
-                    'UPDATE users SET last_completion_date = ?, reminder_count = 0, current_day = ? WHERE telegram_id = ?',
-                    (completion_date, current_day, telegram_id)
+                    'UPDATE users SET last_completion_day = ?, reminder_count = 0, current_day = ? WHERE telegram_id = ?',
+                    (completion_day, current_day, telegram_id)
                 )
             else:
                 await db.execute(
-                    'UPDATE users SET last_completion_date = ?, reminder_count = 0 WHERE telegram_id = ?',
-                    (completion_date, telegram_id)
+                    'UPDATE users SET last_completion_day = ?, reminder_count = 0 WHERE telegram_id = ?',
+                    (completion_day, telegram_id)
+                )
+            
+            # История выполнений пишется в той же транзакции и только дополняется
+            await db.execute(
+                '''INSERT OR IGNORE INTO completions
+                (telegram_id, challenge_id, day_number, completion_day, file_unique_id)
+                VALUES (?, ?, ?, ?, ?)''',
+                (telegram_id, challenge_id, current_day, completion_day, file_unique_id)
+            )
+            if challenge_id:
+                await self._extend_streak(db, challenge_id, telegram_id, completion_day)
+            users = await self._read_users(db, [telegram_id])
+        self._apply_counters(changes)
+        self._apply_users(users)
+
+    async def complete_today(self, telegram_id: int, file_unique_id: str = None, build_posts=None):
+        # Выполнение за сегодня одной транзакцией: проверка статуса и дня челленджа,
+        # отметка (только если сегодня еще не отмечено), история, счетчики и
+        # публикации в канал. build_posts(day, challenge_info) возвращает список
+        # (вид, payload) для channel_queue. Возвращает (результат, день, challenge_info)
+        today = date.today().toordinal()
+        changes = {}
+        
+        async with self.pool.write() as db:
+            async with db.execute(
+                'SELECT status, start_day, last_completion_day, reminder_day, reminder_count, challenge_id FROM users WHERE telegram_id = ?',
+                (telegram_id,)
+            ) as cursor:
+                user = await cursor.fetchone()
+            if not user:
+                return COMPLETION_NOT_REGISTERED, 0, None
+            status, start_day, last_completion_day, reminder_day, reminder_count, challenge_id = user
+            # Поток пользователя берется из кэша, без обращения к БД
+            challenge_info = await self.get_challenge_info(challenge_id) if challenge_id else None
+            
+            user_day = challenge_day(start_day, challenge_info['total_days'], today) if start_day and challenge_info else 1
+            if status == USER_BLOCKED:
+                return COMPLETION_BLOCKED, user_day, challenge_info
+            if user_day == 0:
+                return COMPLETION_NOT_STARTED, user_day, challenge_info
+            if last_completion_day == today:
+                return COMPLETION_ALREADY_DONE, user_day, challenge_info
+            
+            if status == USER_ACTIVE:
+                changes[(STAT_COMPLETED, today)] = 1
+            if reminder_day == today and reminder_count > 0:
+                changes[(STAT_REMINDED, today)] = -1
+            await self._change_counters(db, changes)
+            
+            stored_day = today - start_day + 1 if start_day else None
+            await db.execute(
+                '''UPDATE users SET last_completion_day = :today, reminder_count = 0,
+                    current_day = IFNULL(:stored_day, current_day)
+                WHERE telegram_id = :telegram_id''',
+                {'today': today, 'stored_day': stored_day, 'telegram_id': telegram_id}
+            )
+            await db.execute(
+                '''INSERT OR IGNORE INTO completions
+                (telegram_id, challenge_id, day_number, completion_day, file_unique_id)
+                VALUES (?, ?, ?, ?, ?)''',
+                (telegram_id, challenge_info['id'] if challenge_info else None, stored_day, today, file_unique_id)
+            )
+            if challenge_info:
+                await self._extend_streak(db, challenge_info['id'], telegram_id, today)
+            if build_posts:
+                await db.executemany(
+                    'INSERT INTO channel_queue (kind, payload) VALUES (?, ?)',
+                    build_posts(user_day, challenge_info)
                 )
-            await db.commit()
+            users = await self._read_users(db, [telegram_id])
+        self._apply_counters(changes)
+        self._apply_users(users)
+        return COMPLETION_DONE, user_day, challenge_info
 
-    async def reset_daily_completions(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Сбрасываем last_completion_date и reminder_count
-            await db.execute('UPDATE users SET last_completion_date = NULL, reminder_count = 0')
-            await db.commit()
+    async def _extend_streak(self, db, challenge_id: int, telegram_id: int, day: int):
+        # Серия продолжается, если предыдущее выполнение было вчера; повторная
+        # отметка того же дня и отметки задним числом серию не меняют.
+        # При записи в поток (INSERT OR REPLACE) серия сбрасывается в 0
+        await db.execute(
+            '''UPDATE challenge_enrollments SET
+                current_streak = CASE
+                    WHEN last_day = :day THEN current_streak
+                    WHEN last_day = :day - 1 THEN current_streak + 1
+                    ELSE 1
+                END,
+                last_day = :day
+            WHERE challenge_id = :challenge_id AND telegram_id = :telegram_id
+            AND (last_day IS NULL OR last_day <= :day)''',
+            {'challenge_id': challenge_id, 'telegram_id': telegram_id, 'day': day}
+        )
 
     async def get_all_active_users(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             async with db.execute(
                 'SELECT telegram_id, username FROM users WHERE status = ?', 
                 (USER_ACTIVE,)
@@ -97,147 +517,887 @@ class Database:
                 return await cursor.fetchall()
 
     async def get_all_users(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             async with db.execute(
-                'SELECT telegram_id, username, status, reminder_count, current_day FROM users'
+                f'''SELECT u.telegram_id, u.username, u.status,
+                    {REMINDER_COUNT_SQL}, {CURRENT_DAY_SQL}
+                FROM users u {CHALLENGE_JOIN}''',
+                {'today': date.today().toordinal()}
             ) as cursor:
                 return await cursor.fetchall()
 
-    async def get_users_without_today_completion(self):
-        today = date.today()
-        async with aiosqlite.connect(self.db_path) as db:
+    async def get_users_page(self, after_id: int = None, before_id: int = None, status: str = None, limit: int = USERS_PAGE_SIZE):
+        # Постраничный список по telegram_id без OFFSET: страница после after_id
+        # или перед before_id. Возвращает (строки по возрастанию id, есть ли
+        # еще строки в направлении листания)
+        conditions = []
+        params = {'today': date.today().toordinal(), 'limit': limit + 1}
+        if status:
+            conditions.append('u.status = :status')
+            params['status'] = status
+        if before_id is not None:
+            conditions.append('u.telegram_id < :anchor')
+            params['anchor'] = before_id
+            order = 'DESC'
+        else:
+            conditions.append('u.telegram_id > :anchor')
+            params['anchor'] = after_id if after_id is not None else -1
+            order = 'ASC'
+        
+        async with self.pool.read() as db:
             async with db.execute(
-                '''SELECT telegram_id, username, reminder_count FROM users 
-                WHERE (last_completion_date != ? OR last_completion_date IS NULL) 
-                AND status = ?''',
-                (today, USER_ACTIVE)
+                f'''SELECT u.telegram_id, u.username, u.status,
+                    {REMINDER_COUNT_SQL}, {CURRENT_DAY_SQL}
+                FROM users u {CHALLENGE_JOIN}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY u.telegram_id {order}
+                LIMIT :limit''',
+                params
             ) as cursor:
                 users = await cursor.fetchall()
-                
-                # Добавляем актуальный текущий день для каждого пользователя
-                result = []
-                for user in users:
-                    telegram_id, username, reminder_count = user
-                    current_day = await self.get_user_current_day(telegram_id)
-                    result.append((telegram_id, username, reminder_count, current_day))
-                
-                return result
+        
+        has_more = len(users) > limit
+        users = users[:limit]
+        if order == 'DESC':
+            users.reverse()
+        return users, has_more
+
+    async def iter_users_without_today_completion(self, chunk_size: int = REMINDER_CHUNK_SIZE, reminder_minutes=None, challenge_ids=None):
+        # Один запрос вместо N+1, строки отдаются пачками. Статус подставлен
+        # литералом под частичные индексы; INDEXED BY нужен, потому что без
+        # статистики ANALYZE планировщик выбирает idx_users_status_id.
+        # reminder_minutes - минуты из reminder_minute, которым пора напоминать,
+        # challenge_ids - потоки, участникам которых нужны напоминания
+        params = {'today': date.today().toordinal()}
+        if reminder_minutes is None:
+            source = 'users u INDEXED BY idx_users_active_completion'
+            conditions = ''
+        else:
+            source = 'users u INDEXED BY idx_users_cohort_reminder'
+            conditions = '''AND u.challenge_id IN (SELECT value FROM json_each(:challenges))
+                AND u.reminder_minute IN (SELECT value FROM json_each(:minutes))'''
+            params['minutes'] = json.dumps(list(reminder_minutes))
+            params['challenges'] = json.dumps(list(challenge_ids or []))
+        
+        async with self.pool.read() as db:
+            async with db.execute(
+                f'''SELECT u.telegram_id, u.username, {REMINDER_COUNT_SQL}, {CURRENT_DAY_SQL}, u.challenge_id
+                FROM {source} {CHALLENGE_JOIN}
+                WHERE u.status = '{USER_ACTIVE}' {conditions}
+                AND IFNULL(u.last_completion_day, 0) < :today''',
+                params
+            ) as cursor:
+                while True:
+                    users = await cursor.fetchmany(chunk_size)
+                    if not users:
+                        break
+                    yield users
+
+    # Выгрузка для CSV: строки читаются курсором пачками
+    async def iter_users_export(self, chunk_size: int = EXPORT_CHUNK_SIZE):
+        async with self.pool.read() as db:
+            async with db.execute(
+                f'''SELECT u.telegram_id, u.username, u.status, u.last_completion_day,
+                    {REMINDER_COUNT_SQL}, {CURRENT_DAY_SQL}, u.start_day, u.tz_offset, u.challenge_id, u.created_at
+                FROM users u {CHALLENGE_JOIN}
+                ORDER BY u.telegram_id''',
+                {'today': date.today().toordinal()}
+            ) as cursor:
+                while True:
+                    users = await cursor.fetchmany(chunk_size)
+                    if not users:
+                        break
+                    yield users
+
+    async def iter_completions_export(self, chunk_size: int = EXPORT_CHUNK_SIZE):
+        async with self.pool.read() as db:
+            async with db.execute(
+                '''SELECT telegram_id, challenge_id, day_number, completion_day, file_unique_id, created_at
+                FROM completions ORDER BY id'''
+            ) as cursor:
+                while True:
+                    completions = await cursor.fetchmany(chunk_size)
+                    if not completions:
+                        break
+                    yield completions
+
+    async def get_users_without_today_completion(self):
+        result = []
+        async for users in self.iter_users_without_today_completion():
+            result.extend(users)
+        return result
 
     async def update_user_status(self, telegram_id: int, status: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Сбрасываем счетчик напоминаний только при активации
+        await self.update_users_status([telegram_id], status)
+
+    async def update_users_status(self, telegram_ids, status: str, from_status: str = None):
+        # Массовая смена статуса одной транзакцией: проверка существования,
+        # обновление и счетчики статистики. from_status - менять только
+        # пользователей с этим статусом. Возвращает (у скольких статус
+        # действительно изменился, неизвестные ID)
+        today = date.today().toordinal()
+        params = {'ids': json.dumps(list(telegram_ids)), 'from_status': from_status}
+        async with self.pool.write() as db:
+            async with db.execute(
+                '''SELECT telegram_id, status, reminder_day, reminder_count, last_completion_day FROM users
+                WHERE telegram_id IN (SELECT value FROM json_each(:ids))
+                AND (:from_status IS NULL OR status = :from_status)''',
+                params
+            ) as cursor:
+                users = await cursor.fetchall()
+            
+            changes = {}
+            for telegram_id, old_status, reminder_day, reminder_count, last_completion_day in users:
+                if old_status != status:
+                    changes[(status_counter(old_status), 0)] = changes.get((status_counter(old_status), 0), 0) - 1
+                    changes[(status_counter(status), 0)] = changes.get((status_counter(status), 0), 0) + 1
+                    # Выполнение за сегодня учитывается, пока пользователь активен
+                    if last_completion_day == today and USER_ACTIVE in (old_status, status):
+                        delta = 1 if status == USER_ACTIVE else -1
+                        changes[(STAT_COMPLETED, today)] = changes.get((STAT_COMPLETED, today), 0) + delta
+                    if status == USER_UNREACHABLE:
+                        changes[(STAT_UNREACHABLE, today)] = changes.get((STAT_UNREACHABLE, today), 0) + 1
+                if status == USER_ACTIVE and reminder_day == today and reminder_count > 0:
+                    changes[(STAT_REMINDED, today)] = changes.get((STAT_REMINDED, today), 0) - 1
+            await self._change_counters(db, changes)
+            
+            # Сбрасываем счетчик напоминаний только при активации,
+            # день перехода в unreachable нужен для статистики
+            extra = ''
             if status == USER_ACTIVE:
-                await db.execute(
-                    'UPDATE users SET status = ?, reminder_count = 0 WHERE telegram_id = ?',
-                    (status, telegram_id)
-                )
-            else:
-                await db.execute(
-                    'UPDATE users SET status = ? WHERE telegram_id = ?',
-                    (status, telegram_id)
-                )
-            await db.commit()
+                extra = ', reminder_count = 0'
+            elif status == USER_UNREACHABLE:
+                extra = ', unreachable_day = :today'
+            await db.execute(
+                f'''UPDATE users SET status = :status{extra}
+                WHERE telegram_id IN (SELECT value FROM json_each(:found))''',
+                {'status': status, 'today': today, 'found': json.dumps([user[0] for user in users])}
+            )
+            rows = await self._read_users(db, [user[0] for user in users])
+        self._apply_counters(changes)
+        self._apply_users(rows)
+        
+        found = {user[0] for user in users}
+        changed = sum(1 for user in users if user[1] != status)
+        return changed, [telegram_id for telegram_id in telegram_ids if telegram_id not in found]
+
+    # Пользователи, которым сообщения не доставляются (бот заблокирован,
+    # аккаунт удален); заблокированных администратором не трогаем
+    async def mark_users_unreachable(self, telegram_ids):
+        if not telegram_ids:
+            return 0
+        updated, _ = await self.update_users_status(telegram_ids, USER_UNREACHABLE, from_status=USER_ACTIVE)
+        return updated
+
+    async def reactivate_user(self, telegram_id: int):
+        # Вызывается на каждое сообщение, поэтому сначала дешевое чтение
+        # (из кэша или по первичному ключу), запись - только для недоступных
+        if self._users is not None:
+            record = self._users.get(telegram_id)
+            user = (record.status,) if record else None
+        else:
+            async with self.pool.read() as db:
+                async with db.execute('SELECT status FROM users WHERE telegram_id = ?', (telegram_id,)) as cursor:
+                    user = await cursor.fetchone()
+        if not user or user[0] != USER_UNREACHABLE:
+            return False
+        updated, _ = await self.update_users_status([telegram_id], USER_ACTIVE, from_status=USER_UNREACHABLE)
+        return updated > 0
 
     async def increment_reminder_count(self, telegram_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        await self.increment_reminder_counts([telegram_id])
+
+    async def increment_reminder_counts(self, telegram_ids):
+        # Увеличивает счетчики всей пачки одной транзакцией и возвращает
+        # {telegram_id: новое значение reminder_count}
+        if not telegram_ids:
+            return {}
+        
+        async with self.pool.write() as db:
+            counts, changes = await self._increment_reminder_counts(db, telegram_ids)
+            users = await self._read_users(db, counts)
+        self._apply_counters(changes)
+        self._apply_users(users)
+        return counts
+
+    async def _increment_reminder_counts(self, db, telegram_ids):
+        today = date.today().toordinal()
+        params = {'today': today, 'ids': json.dumps(list(telegram_ids))}
+        if SQLITE_HAS_RETURNING:
+            async with db.execute(
+                f'''UPDATE users SET {REMINDER_INCREMENT_SQL}
+                WHERE telegram_id IN (SELECT value FROM json_each(:ids))
+                RETURNING telegram_id, reminder_count''',
+                params
+            ) as cursor:
+                counts = dict(await cursor.fetchall())
+        else:
             await db.execute(
-                'UPDATE users SET reminder_count = reminder_count + 1 WHERE telegram_id = ?',
-                (telegram_id,)
+                f'UPDATE users SET {REMINDER_INCREMENT_SQL} WHERE telegram_id IN (SELECT value FROM json_each(:ids))',
+                params
+            )
+            async with db.execute(
+                'SELECT telegram_id, reminder_count FROM users WHERE telegram_id IN (SELECT value FROM json_each(:ids))',
+                params
+            ) as cursor:
+                counts = dict(await cursor.fetchall())
+        
+        # Первое напоминание за день добавляет пользователя в счетчик
+        changes = {(STAT_REMINDED, today): sum(1 for count in counts.values() if count == 1)}
+        await self._change_counters(db, changes)
+        return counts, changes
+
+    # Пачка напоминаний: счетчики и записи журнала рассылки job_id меняются
+    # одной транзакцией, поэтому после сбоя журнал точно знает, кому
+    # счетчик уже увеличен. Пользователи, уже попавшие в журнал, пропускаются.
+    # users - строки iter_users_without_today_completion,
+    # возвращает [(telegram_id, (номер напоминания, день, поток))]
+    async def add_reminder_deliveries(self, job_id: int, users):
+        if not users:
+            return []
+        
+        async with self.pool.write() as db:
+            async with db.execute(
+                '''SELECT chat_id FROM broadcast_deliveries
+                WHERE job_id = ? AND chat_id IN (SELECT value FROM json_each(?))''',
+                (job_id, json.dumps([user[0] for user in users]))
+            ) as cursor:
+                journaled = {row[0] for row in await cursor.fetchall()}
+            users = [user for user in users if user[0] not in journaled]
+            if not users:
+                return []
+            
+            counts, changes = await self._increment_reminder_counts(db, [user[0] for user in users])
+            deliveries = [
+                (telegram_id, (counts.get(telegram_id, reminder_count + 1), current_day, challenge_id))
+                for telegram_id, username, reminder_count, current_day, challenge_id in users
+            ]
+            await db.executemany(
+                'INSERT OR IGNORE INTO broadcast_deliveries (job_id, chat_id, data) VALUES (?, ?, ?)',
+                [(job_id, telegram_id, json.dumps(data)) for telegram_id, data in deliveries]
             )
-            await db.commit()
+            rows = await self._read_users(db, counts)
+        self._apply_counters(changes)
+        self._apply_users(rows)
+        return deliveries
+
+    async def set_user_timezone(self, telegram_id: int, tz_offset: int):
+        # С кэшем изменение записывается в БД отложенно, вместе с другими
+        record = self._users.get(telegram_id) if self._users is not None else None
+        if record:
+            self._defer_user_update(
+                record, tz_offset=tz_offset, reminder_minute=reminder_minute(telegram_id, tz_offset)
+            )
+            return
+        
+        async with self.pool.write() as db:
+            await db.execute(
+                'UPDATE users SET tz_offset = ?, reminder_minute = ? WHERE telegram_id = ?',
+                (tz_offset, reminder_minute(telegram_id, tz_offset), telegram_id)
+            )
+
+    async def update_username(self, telegram_id: int, username: str):
+        # Актуальный username для списков и таблицы лидеров. Только с кэшем:
+        # без него это была бы запись в БД на каждое сообщение
+        record = self._users.get(telegram_id) if self._users is not None else None
+        if record and record.username != username:
+            self._defer_user_update(record, username=username)
 
     async def get_reminder_count(self, telegram_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        if self._users is not None:
+            record = self._users.get(telegram_id)
+            if not record or record.reminder_day != date.today().toordinal():
+                return 0
+            return record.reminder_count
+        
+        async with self.pool.read() as db:
             async with db.execute(
-                'SELECT reminder_count FROM users WHERE telegram_id = ?', 
-                (telegram_id,)
+                f'SELECT {REMINDER_COUNT_SQL} FROM users u WHERE telegram_id = :telegram_id',
+                {'today': date.today().toordinal(), 'telegram_id': telegram_id}
             ) as cursor:
                 result = await cursor.fetchone()
                 return result[0] if result else 0
 
     async def reset_reminder_count(self, telegram_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        today = date.today().toordinal()
+        async with self.pool.write() as db:
+            async with db.execute(
+                'SELECT reminder_day, reminder_count FROM users WHERE telegram_id = ?',
+                (telegram_id,)
+            ) as cursor:
+                user = await cursor.fetchone()
+            
+            changes = {}
+            if user and user[0] == today and user[1] > 0:
+                changes[(STAT_REMINDED, today)] = -1
+            await self._change_counters(db, changes)
+            
             await db.execute(
                 'UPDATE users SET reminder_count = 0 WHERE telegram_id = ?',
                 (telegram_id,)
             )
-            await db.commit()
+            users = await self._read_users(db, [telegram_id])
+        self._apply_counters(changes)
+        self._apply_users(users)
 
-    # Методы для управления челленджем
-    async def set_challenge(self, name: str, task: str, days: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Деактивируем предыдущие челленджи
-            await db.execute('UPDATE challenge_progress SET is_active = FALSE')
-            
-            # Создаем новый челлендж (начинается со следующего дня)
-            start_date = date.today() + timedelta(days=1)
+    # Счетчики статистики: меняются в тех же транзакциях, что и users,
+    # копия в памяти обновляется только после успешного коммита
+    async def _change_counters(self, db, changes):
+        for (name, day), delta in changes.items():
+            if delta:
+                await db.execute(
+                    '''INSERT INTO stats_counters (name, day, value) VALUES (?, ?, ?)
+                    ON CONFLICT (name, day) DO UPDATE SET value = value + excluded.value''',
+                    (name, day, delta)
+                )
+
+    def _apply_counters(self, changes):
+        for key, delta in changes.items():
+            self._stats[key] = self._stats.get(key, 0) + delta
+
+    async def get_stats(self):
+        today = date.today().toordinal()
+        if self.shared:
+            # Копия в памяти не видит изменений других процессов
+            async with self.pool.read() as db:
+                async with db.execute(
+                    'SELECT name, day, value FROM stats_counters WHERE day IN (0, ?)',
+                    (today,)
+                ) as cursor:
+                    self._stats = {(name, day): value for name, day, value in await cursor.fetchall()}
+        return {
+            'total': self._stats.get((STAT_USERS, 0), 0),
+            'active': self._stats.get((status_counter(USER_ACTIVE), 0), 0),
+            'blocked': self._stats.get((status_counter(USER_BLOCKED), 0), 0),
+            'unreachable': self._stats.get((status_counter(USER_UNREACHABLE), 0), 0),
+            'unreachable_today': self._stats.get((STAT_UNREACHABLE, today), 0),
+            'completed_today': self._stats.get((STAT_COMPLETED, today), 0),
+            'with_reminders': self._stats.get((STAT_REMINDED, today), 0),
+        }
+
+    async def reconcile_stats(self):
+        # Пересчитывает счетчики по таблице users и исправляет расхождения
+        today = date.today().toordinal()
+        async with self.pool.write() as db:
+            actual = {}
+            async with db.execute('SELECT status, COUNT(*) FROM users GROUP BY status') as cursor:
+                for status, count in await cursor.fetchall():
+                    actual[(status_counter(status), 0)] = count
+            async with db.execute(
+                f'''SELECT COUNT(*),
+                    COALESCE(SUM(status = '{USER_ACTIVE}' AND last_completion_day = :today), 0),
+                    COALESCE(SUM(reminder_day = :today AND reminder_count > 0), 0),
+                    COALESCE(SUM(unreachable_day = :today), 0)
+                FROM users''',
+                {'today': today}
+            ) as cursor:
+                total, completed, reminded, unreachable = await cursor.fetchone()
+            actual[(STAT_USERS, 0)] = total
+            actual[(STAT_COMPLETED, today)] = completed
+            actual[(STAT_REMINDED, today)] = reminded
+            actual[(STAT_UNREACHABLE, today)] = unreachable
             
-            await db.execute(
-                'INSERT INTO challenge_progress (challenge_name, challenge_task, total_days, start_date, current_day, is_active) VALUES (?, ?, ?, ?, ?, ?)',
-                (name, task, days, start_date, 1, True)
-            )
+            stored = {}
+            async with db.execute(
+                'SELECT name, day, value FROM stats_counters WHERE day IN (0, ?)',
+                (today,)
+            ) as cursor:
+                for name, day, value in await cursor.fetchall():
+                    stored[(name, day)] = value
             
-            # Сбрасываем прогресс всех пользователей
-            await db.execute('UPDATE users SET start_date = ?, current_day = 1, reminder_count = 0', (start_date,))
+            corrected = {key: value for key, value in actual.items() if stored.get(key, 0) != value}
+            for key, value in stored.items():
+                if key not in actual and value != 0:
+                    corrected[key] = 0
             
-            await db.commit()
+            for (name, day), value in corrected.items():
+                await db.execute(
+                    '''INSERT INTO stats_counters (name, day, value) VALUES (?, ?, ?)
+                    ON CONFLICT (name, day) DO UPDATE SET value = excluded.value''',
+                    (name, day, value)
+                )
+        
+        self._stats = {**stored, **corrected}
+        if corrected:
+            logging.info(f"Stats counters reconciled, corrected: {corrected}")
+        return corrected
 
-    async def get_current_challenge(self):
-        async with aiosqlite.connect(self.db_path) as db:
+    # Методы для управления челленджами (потоками). Одновременно может идти
+    # несколько потоков; новые участники записываются в основной поток
+    async def create_challenge(self, name: str, task: str, days: int):
+        # Новый поток начинается со следующего дня и становится основным
+        start_day = (date.today() + timedelta(days=1)).toordinal()
+        async with self.pool.write() as db:
             async with db.execute(
-                'SELECT challenge_name, challenge_task, total_days, start_date, current_day FROM challenge_progress WHERE is_active = TRUE ORDER BY id DESC LIMIT 1'
+                'INSERT INTO challenge_progress (challenge_name, challenge_task, total_days, start_day, current_day, is_active) VALUES (?, ?, ?, ?, ?, ?)',
+                (name, task, days, start_day, 1, True)
             ) as cursor:
-                return await cursor.fetchone()
+                challenge_id = cursor.lastrowid
+            await self._set_setting(db, SETTING_DEFAULT_CHALLENGE, challenge_id)
+        
+        self.invalidate_challenge_cache()
+        return challenge_id
+
+    async def set_challenge(self, name: str, task: str, days: int):
+        # Прежнее поведение: новый челлендж для всех пользователей сразу
+        challenge_id = await self.create_challenge(name, task, days)
+        await self.enroll_users(challenge_id)
+        return challenge_id
 
-    async def increment_challenge_day(self):
-        async with aiosqlite.connect(self.db_path) as db:
+    async def enroll_users(self, challenge_id: int, telegram_ids=None):
+        # Переводит пользователей в поток (None - всех) и начинает их прогресс
+        # заново. Возвращает (сколько переведено, неизвестные ID)
+        challenge = await self.get_current_challenge(challenge_id)
+        if not challenge:
+            return 0, list(telegram_ids or [])
+        # Записавшиеся после начала потока начинают со своего первого дня
+        start_day = max(challenge[3], date.today().toordinal())
+        
+        if telegram_ids is None:
+            condition, params = '1', {}
+        else:
+            condition, params = 'telegram_id IN (SELECT value FROM json_each(:ids))', {'ids': json.dumps(list(telegram_ids))}
+        params.update({'challenge_id': challenge_id, 'start_day': start_day})
+        
+        async with self.pool.write() as db:
+            async with db.execute(f'SELECT telegram_id FROM users WHERE {condition}', params) as cursor:
+                enrolled = [row[0] for row in await cursor.fetchall()]
+            await db.execute(
+                f'''UPDATE users SET challenge_id = :challenge_id, start_day = :start_day,
+                    current_day = 1, reminder_count = 0
+                WHERE {condition}''',
+                params
+            )
             await db.execute(
-                'UPDATE challenge_progress SET current_day = current_day + 1 WHERE is_active = TRUE'
+                f'''INSERT OR REPLACE INTO challenge_enrollments (challenge_id, telegram_id, start_day)
+                SELECT :challenge_id, telegram_id, :start_day FROM users WHERE {condition}''',
+                params
             )
-            await db.commit()
+            users = await self._read_users(db, enrolled)
+        self._apply_users(users)
+        
+        # Сброс напоминаний затронул счетчики статистики - пересчитываем
+        await self.reconcile_stats()
+        if telegram_ids is None:
+            return len(enrolled), []
+        found = set(enrolled)
+        return len(found), [telegram_id for telegram_id in telegram_ids if telegram_id not in found]
+
+    async def set_default_challenge(self, challenge_id: int):
+        async with self.pool.write() as db:
+            await self._set_setting(db, SETTING_DEFAULT_CHALLENGE, challenge_id)
+        self.invalidate_challenge_cache()
+
+    async def finish_challenge(self, challenge_id: int):
+        # Завершенный поток больше не получает напоминаний; участники остаются в нем
+        async with self.pool.write() as db:
+            await db.execute('UPDATE challenge_progress SET is_active = FALSE WHERE id = ?', (challenge_id,))
+        self.invalidate_challenge_cache()
+
+    async def _set_setting(self, db, key: str, value):
+        await db.execute(
+            'INSERT INTO admin_settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+            (key, str(value))
+        )
+
+    async def _load_challenges(self):
+        # Все активные потоки и основной поток одним чтением
+        async with self.pool.read() as db:
+            async with db.execute(
+                'SELECT challenge_name, challenge_task, total_days, start_day, id FROM challenge_progress WHERE is_active = TRUE ORDER BY id'
+            ) as cursor:
+                challenges = {row[4]: row for row in await cursor.fetchall()}
+            async with db.execute(
+                'SELECT value FROM admin_settings WHERE key = ?', (SETTING_DEFAULT_CHALLENGE,)
+            ) as cursor:
+                setting = await cursor.fetchone()
+        
+        default_id = int(setting[0]) if setting and setting[0] else None
+        if default_id not in challenges:
+            # Основной поток не выбран или завершен - берем последний созданный
+            default_id = max(challenges) if challenges else None
+        return challenges, default_id
+
+    async def get_current_challenge(self, challenge_id: int = None):
+        # Активный поток по id, без id - основной поток
+        if self._challenge_cached and self.shared and time.monotonic() - self._challenge_cached_at > SHARED_CACHE_TTL:
+            self.invalidate_challenge_cache()
+        
+        if self._challenge_cached:
+            self.challenge_cache_hits += 1
+        else:
+            self.challenge_cache_misses += 1
+            generation = self._challenge_generation
+            challenges, default_id = await self._load_challenges()
+            # Не кэшируем результат, если потоки изменились во время запроса
+            if generation != self._challenge_generation:
+                return challenges.get(challenge_id or default_id)
+            self._challenges = challenges
+            self._default_challenge_id = default_id
+            self._challenge_cached = True
+            self._challenge_cached_at = time.monotonic()
+        
+        return self._challenges.get(challenge_id or self._default_challenge_id)
+
+    async def get_active_challenges(self):
+        await self.get_current_challenge()
+        return [self._challenge_info(challenge) for challenge in self._challenges.values()]
+
+    async def get_running_challenges(self):
+        # Начавшиеся активные потоки - только их участникам нужны напоминания
+        today = date.today().toordinal()
+        return [challenge for challenge in await self.get_active_challenges() if challenge['start_day'] <= today]
+
+    async def get_default_challenge_id(self):
+        await self.get_current_challenge()
+        return self._default_challenge_id
 
     async def get_user_current_day(self, telegram_id: int):
         user = await self.get_user(telegram_id)
-        challenge = await self.get_current_challenge()
+        _, user_day = await self._user_challenge(user)
+        return user_day
+
+    async def get_user_challenge_info(self, telegram_id: int):
+        # Поток пользователя и его текущий день: (challenge_info или None, день)
+        user = await self.get_user(telegram_id)
+        return await self._user_challenge(user)
+
+    async def _user_challenge(self, user):
+        if not user or not user[11]:  # challenge_id
+            return None, 1
+        challenge = await self.get_current_challenge(user[11])
+        if not challenge:
+            return None, 1
+        if user[6]:  # start_day
+            return self._challenge_info(challenge), challenge_day(user[6], challenge[2], date.today().toordinal())
+        return self._challenge_info(challenge), 1
+
+    def _challenge_info(self, challenge):
+        name, task, total_days, start_day, challenge_id = challenge
+        return {
+            'id': challenge_id,
+            'name': name,
+            'task': task,
+            'total_days': total_days,
+            'start_day': start_day,
+            'start_date': date.fromordinal(start_day),
+            # День челленджа вычисляется по дате, а не хранится счетчиком
+            'current_day': challenge_day(start_day, total_days, date.today().toordinal())
+        }
+
+    async def get_challenge_info(self, challenge_id: int = None):
+        challenge = await self.get_current_challenge(challenge_id)
+        return self._challenge_info(challenge) if challenge else None
+
+    async def update_challenge_task(self, task: str, challenge_id: int = None):
+        if challenge_id is None:
+            challenge_id = await self.get_default_challenge_id()
+        async with self.pool.write() as db:
+            await db.execute(
+                'UPDATE challenge_progress SET challenge_task = ? WHERE id = ?',
+                (task, challenge_id)
+            )
         
-        if user and user[6] and challenge:  # start_date
-            start_date = datetime.strptime(user[6], '%Y-%m-%d').date()
-            today = date.today()
-            
-            # Если челлендж еще не начался
-            if today < start_date:
+        self.invalidate_challenge_cache()
+
+    async def get_cohort_stats(self, challenge_id: int):
+        # Статистика одного потока: читаются только его строки (idx_users_cohort_status)
+        today = date.today().toordinal()
+        async with self.pool.read() as db:
+            async with db.execute(
+                f'''SELECT COUNT(*),
+                    COALESCE(SUM(status = '{USER_ACTIVE}'), 0),
+                    COALESCE(SUM(status = '{USER_ACTIVE}' AND last_completion_day = :today), 0),
+                    COALESCE(SUM(reminder_day = :today AND reminder_count > 0), 0)
+                FROM users WHERE challenge_id = :challenge_id''',
+                {'today': today, 'challenge_id': challenge_id}
+            ) as cursor:
+                total, active, completed, reminded = await cursor.fetchone()
+        return {'total': total, 'active': active, 'completed_today': completed, 'with_reminders': reminded}
+
+    # История выполнений: серии, пропуски и таблица лидеров
+    async def get_user_streak(self, telegram_id: int, challenge_id: int):
+        # Возвращает (текущая серия, лучшая серия, всего выполнено).
+        # Серия - подряд идущие дни; текущая жива, если последний день - вчера или сегодня
+        yesterday = date.today().toordinal() - 1
+        async with self.pool.read() as db:
+            async with db.execute(
+                '''WITH days AS (
+                    SELECT completion_day,
+                        completion_day - ROW_NUMBER() OVER (ORDER BY completion_day) AS grp
+                    FROM completions
+                    WHERE telegram_id = :telegram_id AND challenge_id = :challenge_id
+                ),
+                runs AS (
+                    SELECT COUNT(*) AS length, MAX(completion_day) AS last_day
+                    FROM days GROUP BY grp
+                )
+                SELECT
+                    COALESCE((SELECT length FROM runs WHERE last_day >= :yesterday), 0),
+                    COALESCE(MAX(length), 0),
+                    COALESCE(SUM(length), 0)
+                FROM runs''',
+                {'telegram_id': telegram_id, 'challenge_id': challenge_id, 'yesterday': yesterday}
+            ) as cursor:
+                return await cursor.fetchone()
+
+    async def get_missed_days(self, telegram_id: int, challenge_id: int, last_day: int):
+        # Номера дней с 1 по last_day включительно, за которые нет выполнения
+        async with self.pool.read() as db:
+            async with db.execute(
+                '''WITH RECURSIVE days(n) AS (
+                    SELECT 1 WHERE :last_day >= 1
+                    UNION ALL
+                    SELECT n + 1 FROM days WHERE n < :last_day
+                )
+                SELECT n FROM days
+                WHERE n NOT IN (
+                    SELECT day_number FROM completions
+                    WHERE telegram_id = :telegram_id AND challenge_id = :challenge_id
+                    AND day_number IS NOT NULL
+                )''',
+                {'telegram_id': telegram_id, 'challenge_id': challenge_id, 'last_day': last_day}
+            ) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def reset_broken_streaks(self):
+        # Вызывается при смене дня: серии без выполнения вчера прерваны.
+        # Обнуление убирает их с верха idx_enrollments_streak
+        yesterday = date.today().toordinal() - 1
+        async with self.pool.write() as db:
+            async with db.execute(
+                'UPDATE challenge_enrollments SET current_streak = 0 WHERE current_streak > 0 AND last_day < ?',
+                (yesterday,)
+            ) as cursor:
+                return cursor.rowcount
+
+    async def get_streak_leaderboard(self, challenge_id: int, limit: int = LEADERBOARD_SIZE):
+        # Топ по текущей серии - чтение верха индекса idx_enrollments_streak.
+        # Прерванные серии обнуляет reset_broken_streaks; фильтр по last_day
+        # нужен, пока сброса еще не было (например, бот не работал в полночь)
+        yesterday = date.today().toordinal() - 1
+        async with self.pool.read() as db:
+            async with db.execute(
+                '''SELECT e.telegram_id, u.username, e.current_streak
+                FROM challenge_enrollments e JOIN users u ON u.telegram_id = e.telegram_id
+                WHERE e.challenge_id = :challenge_id AND e.current_streak > 0
+                AND e.last_day >= :yesterday
+                ORDER BY e.current_streak DESC, e.telegram_id
+                LIMIT :limit''',
+                {'challenge_id': challenge_id, 'yesterday': yesterday, 'limit': limit}
+            ) as cursor:
+                return await cursor.fetchall()
+
+    # Очередь публикаций в канал
+    async def enqueue_channel_posts(self, posts):
+        async with self.pool.write() as db:
+            await db.executemany(
+                'INSERT INTO channel_queue (kind, payload) VALUES (?, ?)',
+                posts
+            )
+
+    async def get_channel_queue_head(self, limit: int, exclude_kinds=()):
+        # exclude_kinds - виды публикаций, которые ждут сводки дайджеста
+        async with self.pool.read() as db:
+            async with db.execute(
+                f'''SELECT id, kind, payload, attempts, next_attempt_at FROM channel_queue
+                WHERE status = '{QUEUE_PENDING}' AND kind NOT IN (SELECT value FROM json_each(?))
+                ORDER BY id LIMIT ?''',
+                (json.dumps(list(exclude_kinds)), limit)
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def get_channel_digest_state(self, kinds, counted_kind: str):
+        # Сколько публикаций counted_kind ждет дайджеста и когда (unix time)
+        # поставлена в очередь самая старая из публикаций kinds
+        async with self.pool.read() as db:
+            async with db.execute(
+                f'''SELECT COALESCE(SUM(kind = ?), 0), CAST(strftime('%s', MIN(created_at)) AS INTEGER)
+                FROM channel_queue
+                WHERE status = '{QUEUE_PENDING}' AND kind IN (SELECT value FROM json_each(?))''',
+                (counted_kind, json.dumps(list(kinds)))
+            ) as cursor:
+                return await cursor.fetchone()
+
+    async def collapse_channel_digest(self, kinds, build_posts):
+        # Публикации kinds заменяются обычными публикациями из
+        # build_posts([(вид, payload)]) одной транзакцией: сводка не теряется
+        # и не дублируется при перезапуске. Возвращает число свернутых записей
+        async with self.pool.write() as db:
+            async with db.execute(
+                f'''SELECT id, kind, payload FROM channel_queue
+                WHERE status = '{QUEUE_PENDING}' AND kind IN (SELECT value FROM json_each(?))
+                ORDER BY id''',
+                (json.dumps(list(kinds)),)
+            ) as cursor:
+                entries = await cursor.fetchall()
+            if not entries:
                 return 0
-                
-            # Вычисляем текущий день
-            days_since_start = (today - start_date).days
-            current_day = days_since_start + 1
-            
-            # Не превышаем общее количество дней
-            total_days = challenge[2]
-            if current_day > total_days:
-                return total_days
-                
-            return current_day
             
-        return 1
+            await db.execute(
+                'DELETE FROM channel_queue WHERE id IN (SELECT value FROM json_each(?))',
+                (json.dumps([entry[0] for entry in entries]),)
+            )
+            await db.executemany(
+                'INSERT INTO channel_queue (kind, payload) VALUES (?, ?)',
+                build_posts([(kind, payload) for _, kind, payload in entries])
+            )
+        return len(entries)
 
-    async def get_challenge_info(self):
-        challenge = await self.get_current_challenge()
-        if challenge:
-            name, task, total_days, start_date, current_day = challenge
-            return {
-                'name': name,
-                'task': task,
-                'total_days': total_days,
-                'start_date': start_date,
-                'current_day': current_day
-            }
-        return None
-
-    async def update_challenge_task(self, task: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                'UPDATE challenge_progress SET challenge_task = ? WHERE is_active = TRUE',
-                (task,)
-            )
-            await db.commit()
+    async def get_channel_digest_mode(self):
+        # Как и кэш челленджа: при нескольких процессах перечитываем по TTL
+        if self._channel_digest is not None and self.shared and time.monotonic() - self._channel_digest_at > SHARED_CACHE_TTL:
+            self._channel_digest = None
+        
+        if self._channel_digest is None:
+            async with self.pool.read() as db:
+                async with db.execute(
+                    'SELECT value FROM admin_settings WHERE key = ?', (SETTING_CHANNEL_DIGEST,)
+                ) as cursor:
+                    setting = await cursor.fetchone()
+            self._channel_digest = setting[0] == '1' if setting else CHANNEL_DIGEST_MODE
+            self._channel_digest_at = time.monotonic()
+        return self._channel_digest
+
+    async def set_channel_digest_mode(self, enabled: bool):
+        async with self.pool.write() as db:
+            await self._set_setting(db, SETTING_CHANNEL_DIGEST, '1' if enabled else '0')
+        self._channel_digest = enabled
+        self._channel_digest_at = time.monotonic()
+
+    async def delete_channel_post(self, post_id: int):
+        async with self.pool.write() as db:
+            await db.execute('DELETE FROM channel_queue WHERE id = ?', (post_id,))
+
+    async def reschedule_channel_post(self, post_id: int, attempts: int, next_attempt_at: float, failed: bool):
+        # После последней попытки публикация остается в таблице со статусом failed
+        async with self.pool.write() as db:
+            await db.execute(
+                'UPDATE channel_queue SET attempts = ?, next_attempt_at = ?, status = ? WHERE id = ?',
+                (attempts, next_attempt_at, QUEUE_FAILED if failed else QUEUE_PENDING, post_id)
+            )
+
+    # Состояния FSM: key - ключ StorageKey, data хранится в JSON.
+    # Каждая запись продлевает жизнь состояния до expires_at
+    async def get_fsm_record(self, key: str):
+        async with self.pool.read() as db:
+            async with db.execute(
+                'SELECT state, data FROM fsm_states WHERE key = ? AND expires_at > ?',
+                (key, time.time())
+            ) as cursor:
+                return await cursor.fetchone()
+
+    async def set_fsm_state(self, key: str, state: str, expires_at: float):
+        async with self.pool.write() as db:
+            await db.execute(
+                '''INSERT INTO fsm_states (key, state, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    state = excluded.state,
+                    data = CASE WHEN fsm_states.expires_at > ? THEN fsm_states.data END,
+                    expires_at = excluded.expires_at''',
+                (key, state, expires_at, time.time())
+            )
+
+    async def set_fsm_data(self, key: str, data: str, expires_at: float):
+        async with self.pool.write() as db:
+            await db.execute(
+                '''INSERT INTO fsm_states (key, data, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    state = CASE WHEN fsm_states.expires_at > ? THEN fsm_states.state END,
+                    data = excluded.data,
+                    expires_at = excluded.expires_at''',
+                (key, data, expires_at, time.time())
+            )
+
+    async def delete_expired_fsm_states(self):
+        async with self.pool.write() as db:
+            cursor = await db.execute('DELETE FROM fsm_states WHERE expires_at <= ?', (time.time(),))
+            return cursor.rowcount
+
+    # Журнал рассылок
+    async def create_broadcast_job(self, name: str, params=None, reminder_tick: int = None):
+        # params - параметры выборки получателей (JSON) для продолжения после сбоя.
+        # reminder_tick - минута напоминаний, которую покрывает запуск: сохраняется
+        # той же транзакцией, чтобы после сбоя ее не обработать второй раз
+        async with self.pool.write() as db:
+            cursor = await db.execute(
+                'INSERT INTO broadcast_jobs (name, params, created_day) VALUES (?, ?, ?)',
+                (name, json.dumps(params), date.today().toordinal())
+            )
+            if reminder_tick is not None:
+                await self._set_setting(db, SETTING_REMINDER_TICK, reminder_tick)
+            return cursor.lastrowid
+
+    async def get_reminder_tick(self):
+        async with self.pool.read() as db:
+            async with db.execute(
+                'SELECT value FROM admin_settings WHERE key = ?', (SETTING_REMINDER_TICK,)
+            ) as cursor:
+                setting = await cursor.fetchone()
+        return int(setting[0]) if setting and setting[0] else None
+
+    async def set_reminder_tick(self, minute: int):
+        async with self.pool.write() as db:
+            await self._set_setting(db, SETTING_REMINDER_TICK, minute)
+
+    async def record_broadcast_results(self, job_id: int, results):
+        # results - пары (chat_id, текст ошибки или None при успехе)
+        async with self.pool.write() as db:
+            await db.executemany(
+                'UPDATE broadcast_deliveries SET status = ?, error = ? WHERE job_id = ? AND chat_id = ?',
+                [
+                    (DELIVERY_SENT if error is None else DELIVERY_FAILED, error, job_id, chat_id)
+                    for chat_id, error in results
+                ]
+            )
+
+    async def finish_broadcast_job(self, job_id: int, status: str = JOB_DONE):
+        async with self.pool.write() as db:
+            await db.execute(
+                'UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?',
+                (status, job_id)
+            )
+
+    async def get_unfinished_broadcast_jobs(self):
+        async with self.pool.read() as db:
+            async with db.execute(
+                f"SELECT id, name, params, created_day FROM broadcast_jobs WHERE status = '{JOB_RUNNING}' ORDER BY id"
+            ) as cursor:
+                return [
+                    (job_id, name, json.loads(params), created_day)
+                    for job_id, name, params, created_day in await cursor.fetchall()
+                ]
+
+    async def iter_pending_deliveries(self, job_id: int, chunk_size: int = REMINDER_CHUNK_SIZE):
+        # Получатели, которым сообщение еще не отправлено: пачки пар (chat_id, data)
+        async with self.pool.read() as db:
+            async with db.execute(
+                f'''SELECT chat_id, data FROM broadcast_deliveries
+                WHERE job_id = ? AND status = '{DELIVERY_PENDING}' ORDER BY chat_id''',
+                (job_id,)
+            ) as cursor:
+                while True:
+                    deliveries = await cursor.fetchmany(chunk_size)
+                    if not deliveries:
+                        break
+                    yield [(chat_id, json.loads(data)) for chat_id, data in deliveries]
+
+    async def delete_old_broadcast_jobs(self, keep_days: int):
+        # Завершенные рассылки старше keep_days дней удаляются вместе с журналом
+        before = date.today().toordinal() - keep_days
+        async with self.pool.write() as db:
+            await db.execute(
+                f'''DELETE FROM broadcast_deliveries WHERE job_id IN (
+                    SELECT id FROM broadcast_jobs WHERE status != '{JOB_RUNNING}' AND created_day < ?
+                )''',
+                (before,)
+            )
+            cursor = await db.execute(
+                f"DELETE FROM broadcast_jobs WHERE status != '{JOB_RUNNING}' AND created_day < ?",
+                (before,)
+            )
+            return cursor.rowcount
+
+
+# Время и количество строк по каждому публичному методу для /metrics
+instrument_class(Database)
@@ -0,0 +1,67 @@
+import asyncio
+import csv
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import date
+
+from constants import EXPORT_GZIP_THRESHOLD
+
+USERS_EXPORT_HEADER = [
+    'telegram_id', 'username', 'status', 'last_completion_date', 'reminder_count',
+    'current_day', 'start_date', 'tz_offset_minutes', 'challenge_id', 'created_at'
+]
+COMPLETIONS_EXPORT_HEADER = [
+    'telegram_id', 'challenge_id', 'day_number', 'completion_date', 'file_unique_id', 'created_at'
+]
+
+
+def day_to_iso(day):
+    return date.fromordinal(day).isoformat() if day else ''
+
+
+def users_export_row(row):
+    (telegram_id, username, status, last_completion_day, reminder_count,
+     current_day, start_day, tz_offset, challenge_id, created_at) = row
+    return [
+        telegram_id, username or '', status, day_to_iso(last_completion_day), reminder_count,
+        current_day, day_to_iso(start_day), tz_offset, challenge_id or '', created_at
+    ]
+
+
+def completions_export_row(row):
+    telegram_id, challenge_id, day_number, completion_day, file_unique_id, created_at = row
+    return [telegram_id, challenge_id, day_number, day_to_iso(completion_day), file_unique_id or '', created_at]
+
+
+def gzip_file(path: str):
+    with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.remove(path)
+
+
+# Пишет пачки строк из БД во временный CSV-файл, не собирая таблицу в памяти.
+# Файл больше EXPORT_GZIP_THRESHOLD сжимается. Возвращает (каталог, путь к файлу,
+# количество строк); каталог удаляет вызывающий код после отправки
+async def write_csv_export(name: str, header, chunks, convert, gzip_threshold: int = EXPORT_GZIP_THRESHOLD):
+    directory = tempfile.mkdtemp(prefix='export_')
+    path = os.path.join(directory, f"{name}_{date.today().isoformat()}.csv")
+    rows = 0
+    try:
+        # utf-8-sig: Excel правильно открывает кириллицу
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            async for chunk in chunks:
+                writer.writerows(convert(row) for row in chunk)
+                rows += len(chunk)
+
+        if os.path.getsize(path) > gzip_threshold:
+            # Сжатие большого файла заметно по времени - не блокируем цикл событий
+            await asyncio.to_thread(gzip_file, path)
+            path += '.gz'
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return directory, path, rows
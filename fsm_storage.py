@@ -0,0 +1,43 @@
+import json
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from constants import FSM_STATE_TTL
+
+
+# Хранилище состояний FSM в SQLite: диалоги админки переживают перезапуск
+# и доступны всем процессам-обработчикам
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db, ttl: float = FSM_STATE_TTL):
+        self.db = db
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    def _expires_at(self):
+        return time.time() + self.ttl
+
+    async def set_state(self, key, state=None):
+        if isinstance(state, State):
+            state = state.state
+        await self.db.set_fsm_state(self.key_builder.build(key), state, self._expires_at())
+
+    async def get_state(self, key):
+        record = await self.db.get_fsm_record(self.key_builder.build(key))
+        return record[0] if record else None
+
+    async def set_data(self, key, data):
+        await self.db.set_fsm_data(
+            self.key_builder.build(key), json.dumps(data, ensure_ascii=False), self._expires_at()
+        )
+
+    async def get_data(self, key):
+        record = await self.db.get_fsm_record(self.key_builder.build(key))
+        if not record or not record[1]:
+            return {}
+        return json.loads(record[1])
+
+    async def close(self):
+        # Соединения принадлежат Database и закрываются вместе с ней
+        pass
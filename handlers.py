@@ -1,17 +1,44 @@
-from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery
-from aiogram.filters import Command
+from aiogram import Router, F, BaseMiddleware
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, FSInputFile
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from database import Database
-from constants import USER_ACTIVE, USER_BLOCKED, ADMIN_IDS, CHANNEL_ID
-from keyboards import get_start_keyboard, get_admin_keyboard, get_back_keyboard, get_management_keyboard, get_cancel_keyboard, get_challenge_keyboard
+from database import (
+    Database, COMPLETION_NOT_REGISTERED, COMPLETION_BLOCKED, COMPLETION_NOT_STARTED, COMPLETION_ALREADY_DONE
+)
+from constants import (
+    USER_ACTIVE, USER_BLOCKED, USER_UNREACHABLE, ADMIN_IDS, CHANNEL_ID,
+    SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_NEGATIVE_CACHE_TTL,
+    MULTI_PROCESS, SHARED_CACHE_TTL, REMINDER_TIMES, MIN_TZ_OFFSET, MAX_TZ_OFFSET,
+    BULK_STATUS_MAX_IDS, BULK_STATUS_MAX_FILE_SIZE, BULK_UNKNOWN_IDS_SHOWN,
+    CHANNEL_DIGEST_GROUP_VIDEO_NOTES, CHANNEL_DIGEST_INTERVAL_MINUTES, CHANNEL_DIGEST_MAX_COMPLETIONS
+)
+from keyboards import (
+    get_start_keyboard, get_admin_keyboard, get_back_keyboard, get_management_keyboard,
+    get_cancel_keyboard, get_challenge_keyboard, get_users_page_keyboard, get_cohorts_keyboard, get_cohort_keyboard
+)
+from cache import TTLCache
+from publisher import ChannelPublisher, POST_VIDEO_NOTE, POST_TEXT, POST_DIGEST_LINE, POST_DIGEST_VIDEO_NOTE
+from export import (
+    write_csv_export, USERS_EXPORT_HEADER, COMPLETIONS_EXPORT_HEADER, users_export_row, completions_export_row
+)
 from datetime import date, timedelta
 import logging
+import re
+import shutil
 
 router = Router()
 db = Database()
+channel_publisher = ChannelPublisher(db)
+
+# Сколько последних пропущенных дней перечислять в /streak
+MISSED_DAYS_SHOWN = 20
+
+# Результаты проверки подписки: отрицательные живут меньше положительных
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)
+SUBSCRIBED_STATUSES = ['member', 'administrator', 'creator']
 
 class AdminStates(StatesGroup):
     waiting_for_challenge_name = State()
@@ -20,15 +47,55 @@ class AdminStates(StatesGroup):
     waiting_for_block_user_id = State()
     waiting_for_activate_user_id = State()
     waiting_for_update_task = State()
+    waiting_for_cohort_user_ids = State()
+
+def cache_subscription(user_id: int, is_subscribed: bool):
+    ttl = SUBSCRIPTION_CACHE_TTL if is_subscribed else SUBSCRIPTION_NEGATIVE_CACHE_TTL
+    if MULTI_PROCESS:
+        # chat_member приходит только в один процесс, остальные узнают об отписке по истечении TTL
+        ttl = min(ttl, SHARED_CACHE_TTL)
+    subscription_cache.set(user_id, is_subscribed, ttl=ttl)
 
-# Функция проверки подписки на канал
+# Функция проверки подписки на канал (API вызывается только при промахе кэша)
 async def check_channel_subscription(bot, user_id: int) -> bool:
+    is_subscribed = subscription_cache.get(user_id)
+    if is_subscribed is not None:
+        return is_subscribed
+    
     try:
         member = await bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status in ['member', 'administrator', 'creator']
     except Exception as e:
         logging.error(f"Error checking channel subscription for {user_id}: {e}")
         return False
+    
+    is_subscribed = member.status in SUBSCRIBED_STATUSES
+    cache_subscription(user_id, is_subscribed)
+    return is_subscribed
+
+# Обновления состава канала сразу попадают в кэш подписок
+# (бот должен быть администратором канала, чтобы получать chat_member)
+@router.chat_member(F.chat.id == int(CHANNEL_ID))
+async def channel_member_updated(event: ChatMemberUpdated):
+    cache_subscription(
+        event.new_chat_member.user.id,
+        event.new_chat_member.status in SUBSCRIBED_STATUSES
+    )
+
+# Пользователь, помеченный недоступным по ошибкам рассылки (заблокировал
+# бота), снова становится активным, как только напишет боту; заодно
+# обновляется username (с кэшем пользователей - без записи в БД на каждое сообщение).
+# Регистрируется как outer-middleware на сообщения и нажатия кнопок
+class UserActivityMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user:
+            try:
+                if await db.reactivate_user(user.id):
+                    logging.info(f"User {user.id} is reachable again, status restored to active")
+                await db.update_username(user.id, user.username)
+            except Exception as e:
+                logging.error(f"Error updating user {user.id} activity: {e}")
+        return await handler(event, data)
 
 # Простой тестовый хендлер для проверки (только для админов)
 @router.message(Command("test"))
@@ -46,8 +113,7 @@ async def cmd_start(message: Message):
     user = await db.get_user(message.from_user.id)
     
     if user:
-        challenge_info = await db.get_challenge_info()
-        user_day = await db.get_user_current_day(message.from_user.id)
+        challenge_info, user_day = await db.get_user_challenge_info(message.from_user.id)
         
         if challenge_info:
             if user_day == 0:
@@ -91,10 +157,9 @@ async def agree_participation(message: Message):
     
     # Если подписан - продолжаем запись
     await db.add_user(message.from_user.id, message.from_user.username)
-    challenge_info = await db.get_challenge_info()
+    challenge_info, user_day = await db.get_user_challenge_info(message.from_user.id)
     
     if challenge_info:
-        user_day = await db.get_user_current_day(message.from_user.id)
         if user_day == 0:
             challenge_text = (
                 f"🎉 Отлично! Ты записан в челлендж: {challenge_info['name']}\n\n"
@@ -108,7 +173,8 @@ async def agree_participation(message: Message):
                 f"📅 Твой текущий день: {user_day}/{challenge_info['total_days']}\n"
                 f"💪 Сегодня нужно сделать: {user_day} {challenge_info['task']}\n\n"
                 f"Каждый день отправляй кружочек (видео-сообщение), чтобы отметить выполнение задания. "
-                f"Напоминания будут приходить в 7:00, 15:00 и 19:00 по МСК.\n"
+                f"Напоминания будут приходить в течение часа после 7:00, 15:00 и 19:00 по твоему времени "
+                f"(по умолчанию МСК, изменить часовой пояс - /timezone).\n"
                 f"Счетчик напоминаний сбрасывается каждый день в 00:00!"
             )
     else:
@@ -126,73 +192,152 @@ async def decline_participation(message: Message):
         reply_markup=get_back_keyboard() if message.from_user.id in ADMIN_IDS else None
     )
 
+def get_channel_posts(message: Message, user_day: int, challenge_info, digest: bool = False):
+    username = message.from_user.username or 'без username'
+    if digest:
+        # В режиме дайджеста - короткая строка для общей сводки
+        if challenge_info:
+            line = f"@{username} - {user_day}-й день '{challenge_info['name']}' ({user_day} {challenge_info['task']})"
+        else:
+            line = f"@{username}"
+        video_kind = POST_DIGEST_VIDEO_NOTE if CHANNEL_DIGEST_GROUP_VIDEO_NOTES else POST_VIDEO_NOTE
+        return [
+            (video_kind, message.video_note.file_id),
+            (POST_DIGEST_LINE, line)
+        ]
+    
+    if challenge_info:
+        channel_message = (
+            f"🎉 Пользователь: @{username} "
+            f"выполнил {user_day}-й день челленджа '{challenge_info['name']}'!\n"
+            f"💪 Сделано: {user_day} {challenge_info['task']}"
+        )
+    else:
+        channel_message = f"Пользователь: @{username} выполнил сегодняшний челлендж!"
+    return [
+        (POST_VIDEO_NOTE, message.video_note.file_id),
+        (POST_TEXT, channel_message)
+    ]
+
 @router.message(F.video_note)
 async def handle_video_note(message: Message):
-    user = await db.get_user(message.from_user.id)
+    # Проверки, отметка выполнения и постановка в очередь канала - одна транзакция,
+    # поэтому два быстрых кружочка подряд не засчитываются дважды
+    digest = await db.get_channel_digest_mode()
+    result, user_day, challenge_info = await db.complete_today(
+        message.from_user.id,
+        message.video_note.file_unique_id,
+        lambda day, challenge: get_channel_posts(message, day, challenge, digest)
+    )
     
-    if not user:
+    if result == COMPLETION_NOT_REGISTERED:
         await message.answer("Сначала нужно зарегистрироваться через /start")
         return
-    
-    user_status = user[2]  # status field
-    
-    if user_status == USER_BLOCKED:
+    if result == COMPLETION_BLOCKED:
         await message.answer("Вы заблокированы. Обратитесь к администратору для разблокировки.")
         return
-    
-    # Получаем текущий день пользователя
-    user_day = await db.get_user_current_day(message.from_user.id)
-    challenge_info = await db.get_challenge_info()
-    
-    if user_day == 0:
+    if result == COMPLETION_NOT_STARTED:
         await message.answer("Челлендж еще не начался!")
         return
-    
-    today = date.today()
-    last_completion = user[3]  # last_completion_date field
-    
-    if last_completion and last_completion == today.isoformat():
+    if result == COMPLETION_ALREADY_DONE:
         await message.answer("Вы уже выполнили задание на сегодня!")
         return
     
-    # Обновляем выполнение задания
-    await db.update_user_completion(message.from_user.id, today)
+    # Публикация в канал идет в фоне через очередь, чтобы не задерживать ответ
+    channel_publisher.notify()
     
-    # Отправляем в канал
+    # Сообщение пользователю
     if challenge_info:
-        channel_message = (
-            f"🎉 Пользователь: @{message.from_user.username or 'без username'} "
-            f"выполнил {user_day}-й день челленджа '{challenge_info['name']}'!\n"
-            f"💪 Сделано: {user_day} {challenge_info['task']}"
+        await message.answer(
+            f"🎉 Отлично! Ты выполнил {user_day}-й день челленджа!\n"
+            f"💪 Ты сделал(а) {user_day} {challenge_info['task']}!\n"
+            f"📹 Твой кружочек будет опубликован в канале."
         )
     else:
-        channel_message = f"Пользователь: @{message.from_user.username or 'без username'} выполнил сегодняшний челлендж!"
+        await message.answer("Отлично! Ты выполнил задание на сегодня! 🎉 Твой кружочек будет опубликован в канале.")
+
+# Серия выполнений и пропущенные дни
+@router.message(Command("streak"))
+async def cmd_streak(message: Message):
+    user = await db.get_user(message.from_user.id)
+    if not user:
+        await message.answer("Сначала нужно зарегистрироваться через /start")
+        return
     
-    try:
-        # Отправляем видео-кружочек в канал
-        await message.bot.send_video_note(
-            CHANNEL_ID, 
-            message.video_note.file_id
+    challenge_info, user_day = await db.get_user_challenge_info(message.from_user.id)
+    if not challenge_info:
+        await message.answer("В настоящее время нет активного челленджа.")
+        return
+    
+    current_streak, best_streak, total_completed = await db.get_user_streak(
+        message.from_user.id, challenge_info['id']
+    )
+    # Пропуски считаем только за прошедшие дни: сегодня еще можно успеть
+    missed_days = await db.get_missed_days(message.from_user.id, challenge_info['id'], user_day - 1)
+    
+    streak_text = (
+        f"🏆 Челлендж: {challenge_info['name']}\n"
+        f"🔥 Текущая серия: {current_streak} дн.\n"
+        f"🏅 Лучшая серия: {best_streak} дн.\n"
+        f"✅ Выполнено дней: {total_completed}\n"
+        f"❌ Пропущено дней: {len(missed_days)}"
+    )
+    if missed_days:
+        streak_text += f"\n📅 Пропущенные дни: {', '.join(str(day) for day in missed_days[-MISSED_DAYS_SHOWN:])}"
+    
+    await message.answer(streak_text)
+
+def format_tz_offset(tz_offset: int) -> str:
+    sign = '+' if tz_offset >= 0 else '-'
+    hours, minutes = divmod(abs(tz_offset), 60)
+    return f"UTC{sign}{hours}:{minutes:02d}"
+
+def parse_tz_offset(text: str):
+    # "+5", "-3", "5:30", "UTC+3" -> смещение в минутах или None
+    text = text.strip().upper().removeprefix('UTC')
+    sign = -1 if text.startswith('-') else 1
+    hours, _, minutes = text.lstrip('+-').partition(':')
+    if not hours.isdigit() or (minutes and not minutes.isdigit()):
+        return None
+    if int(minutes or 0) >= 60:
+        return None
+    return sign * (int(hours) * 60 + int(minutes or 0))
+
+# Часовой пояс для напоминаний
+@router.message(Command("timezone"))
+async def cmd_timezone(message: Message, command: CommandObject):
+    user = await db.get_user(message.from_user.id)
+    if not user:
+        await message.answer("Сначала нужно зарегистрироваться через /start")
+        return
+    
+    reminder_times = ', '.join(f"{hour:02d}:{minute:02d}" for hour, minute in REMINDER_TIMES)
+    if not command.args:
+        await message.answer(
+            f"🕒 Ваш часовой пояс: {format_tz_offset(user[9])}\n"  # tz_offset field
+            f"Напоминания приходят по местному времени в течение часа после {reminder_times}.\n\n"
+            f"Чтобы изменить пояс, отправьте смещение от UTC, например: /timezone +5 или /timezone -3:30"
         )
-        # Отправляем отдельное сообщение с информацией о пользователе
-        await message.bot.send_message(
-            CHANNEL_ID,
-            channel_message
+        return
+    
+    tz_offset = parse_tz_offset(command.args)
+    if tz_offset is None:
+        await message.answer("Не удалось распознать часовой пояс. Пример: /timezone +5 или /timezone -3:30")
+        return
+    if not MIN_TZ_OFFSET <= tz_offset <= MAX_TZ_OFFSET:
+        # Дальше от МСК напоминания приходили бы уже после смены дня челленджа
+        await message.answer(
+            f"Доступны часовые пояса от {format_tz_offset(MIN_TZ_OFFSET)} до {format_tz_offset(MAX_TZ_OFFSET)}: "
+            f"день челленджа меняется в 00:00 по МСК, и все напоминания должны приходить в пределах этого дня."
         )
-        
-        # Сообщение пользователю
-        if challenge_info:
-            await message.answer(
-                f"🎉 Отлично! Ты выполнил {user_day}-й день челленджа!\n"
-                f"💪 Ты сделал(а) {user_day} {challenge_info['task']}!\n"
-                f"📹 Твой кружочек отправлен в канал."
-            )
-        else:
-            await message.answer("Отлично! Ты выполнил задание на сегодня! 🎉 Твой кружочек отправлен в канал.")
-            
-    except Exception as e:
-        logging.error(f"Failed to send video note to channel: {e}")
-        await message.answer("Отлично! Ты выполнил задание на сегодня! 🎉 (Ошибка отправки в канал)")
+        return
+    
+    await db.set_user_timezone(message.from_user.id, tz_offset)
+    await message.answer(
+        f"✅ Часовой пояс изменен на {format_tz_offset(tz_offset)}.\n"
+        f"Напоминания будут приходить по местному времени после {reminder_times}.\n"
+        f"День челленджа по-прежнему меняется в 00:00 по МСК."
+    )
 
 # Админ панель
 @router.message(Command("admin"))
@@ -214,7 +359,18 @@ async def cancel_action(message: Message, state: FSMContext):
         await state.clear()
         await message.answer("Действие отменено.", reply_markup=get_admin_keyboard())
 
-# Управление челленджем
+# Управление челленджем: несколько потоков, основной - куда записываются новые участники
+def format_challenge_info(challenge_info, is_default: bool):
+    title = "⭐ Основной поток" if is_default else "Поток"
+    return (
+        f"{title}:\n"
+        f"🏆 Название: {challenge_info['name']}\n"
+        f"💪 Задание: {challenge_info['task']}\n"
+        f"📅 Всего дней: {challenge_info['total_days']}\n"
+        f"📅 Начало: {challenge_info['start_date']}\n"
+        f"📅 Текущий день: {challenge_info['current_day']}"
+    )
+
 @router.message(F.text == "📝 Управление челленджем")
 async def manage_challenge(message: Message):
     if message.from_user.id not in ADMIN_IDS:
@@ -222,18 +378,37 @@ async def manage_challenge(message: Message):
     
     challenge_info = await db.get_challenge_info()
     if challenge_info:
-        challenge_text = (
-            f"Текущий челлендж:\n"
-            f"🏆 Название: {challenge_info['name']}\n"
-            f"💪 Задание: {challenge_info['task']}\n"
-            f"📅 Всего дней: {challenge_info['total_days']}\n"
-            f"📅 Начало: {challenge_info['start_date']}\n"
-            f"📅 Текущий день: {challenge_info['current_day']}"
-        )
+        challenge_text = format_challenge_info(challenge_info, True)
+        cohorts = await db.get_active_challenges()
+        if len(cohorts) > 1:
+            challenge_text += f"\n\nАктивных потоков: {len(cohorts)}"
     else:
         challenge_text = "Активный челлендж не установлен"
     
-    await message.answer(challenge_text, reply_markup=get_challenge_keyboard())
+    digest = await db.get_channel_digest_mode()
+    await message.answer(challenge_text, reply_markup=get_challenge_keyboard(digest))
+
+# Режим дайджеста канала: переключается сразу для всех новых выполнений,
+# накопленная сводка при выключении публикуется без ожидания
+@router.callback_query(F.data == "channel_digest")
+async def channel_digest_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+    
+    digest = not await db.get_channel_digest_mode()
+    await db.set_channel_digest_mode(digest)
+    channel_publisher.notify()
+    
+    if digest:
+        text = (
+            f"📰 Дайджест включен: выполнения публикуются в канале сводкой раз в "
+            f"{CHANNEL_DIGEST_INTERVAL_MINUTES} мин. или по {CHANNEL_DIGEST_MAX_COMPLETIONS} выполнений"
+        )
+    else:
+        text = "📰 Дайджест выключен: каждое выполнение публикуется в канале отдельно"
+    await callback.message.edit_reply_markup(reply_markup=get_challenge_keyboard(digest))
+    await callback.answer(text, show_alert=True)
 
 @router.callback_query(F.data == "create_challenge")
 async def create_challenge_callback(callback: CallbackQuery, state: FSMContext):
@@ -243,7 +418,7 @@ async def create_challenge_callback(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "update_task")
 async def update_task_callback(callback: CallbackQuery, state: FSMContext):
-    await callback.message.answer("Введите новое задание для челленджа (например: 'отжиманий', 'приседаний', 'подтягиваний'):", reply_markup=get_cancel_keyboard())
+    await callback.message.answer("Введите новое задание для основного потока (например: 'отжиманий', 'приседаний', 'подтягиваний'):", reply_markup=get_cancel_keyboard())
     await state.set_state(AdminStates.waiting_for_update_task)
     await callback.answer()
 
@@ -271,17 +446,19 @@ async def process_challenge_days(message: Message, state: FSMContext):
         challenge_name = data.get('challenge_name')
         challenge_task = data.get('challenge_task')
         
-        await db.set_challenge(challenge_name, challenge_task, days)
+        # Новый поток не трогает участников других потоков; перевести всех
+        # (как раньше) можно кнопкой под сообщением
+        challenge_id = await db.create_challenge(challenge_name, challenge_task, days)
+        await state.clear()
+        await message.answer("✅ Новый поток создан!", reply_markup=get_admin_keyboard())
         await message.answer(
-            f"✅ Новый челлендж создан!\n"
             f"🏆 Название: {challenge_name}\n"
             f"💪 Задание: {challenge_task}\n"
             f"📅 Дней: {days}\n"
             f"📅 Начало: {date.today() + timedelta(days=1)}\n"
-            f"🔄 Все пользователи начинают с 1 дня",
-            reply_markup=get_admin_keyboard()
+            f"⭐ Новые участники записываются в этот поток",
+            reply_markup=get_cohort_keyboard(challenge_id, True)
         )
-        await state.clear()
         
     except ValueError:
         await message.answer("Неверный формат. Введите число дней:")
@@ -290,12 +467,113 @@ async def process_challenge_days(message: Message, state: FSMContext):
 async def process_update_task(message: Message, state: FSMContext):
     await db.update_challenge_task(message.text)
     await message.answer(
-        f"✅ Задание челленджа обновлено!\n"
+        f"✅ Задание основного потока обновлено!\n"
         f"💪 Новое задание: {message.text}",
         reply_markup=get_admin_keyboard()
     )
     await state.clear()
 
+# Потоки: список, карточка со статистикой и действия.
+# callback_data: cohort:<list|show|default|all|enroll|finish>:<id потока>
+async def build_cohorts_list():
+    cohorts = await db.get_active_challenges()
+    default_id = await db.get_default_challenge_id()
+    if not cohorts:
+        return "Активных потоков нет.", None
+    
+    lines = ["📋 Активные потоки:"]
+    for cohort in cohorts:
+        mark = "⭐ " if cohort['id'] == default_id else ""
+        lines.append(
+            f"{mark}{cohort['name']} - день {cohort['current_day']}/{cohort['total_days']}, "
+            f"начало {cohort['start_date']}"
+        )
+    return "\n".join(lines), get_cohorts_keyboard(cohorts, default_id)
+
+async def build_cohort_card(challenge_id: int):
+    challenge_info = await db.get_challenge_info(challenge_id)
+    if not challenge_info:
+        return "Поток не найден или завершен.", None
+    
+    is_default = challenge_id == await db.get_default_challenge_id()
+    stats = await db.get_cohort_stats(challenge_id)
+    text = (
+        f"{format_challenge_info(challenge_info, is_default)}\n\n"
+        f"👥 Участников: {stats['total']} (активных: {stats['active']})\n"
+        f"📅 Выполнили сегодня: {stats['completed_today']}\n"
+        f"🔔 С напоминаниями сегодня: {stats['with_reminders']}"
+    )
+    return text, get_cohort_keyboard(challenge_id, is_default)
+
+@router.callback_query(F.data.startswith("cohort:"))
+async def cohort_callback(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+    
+    _, action, challenge_id = callback.data.split(":")
+    challenge_id = int(challenge_id)
+    
+    if action == "list":
+        text, keyboard = await build_cohorts_list()
+        await callback.message.answer(text, reply_markup=keyboard)
+    elif action == "show":
+        text, keyboard = await build_cohort_card(challenge_id)
+        await callback.message.answer(text, reply_markup=keyboard)
+    elif action == "default":
+        await db.set_default_challenge(challenge_id)
+        await callback.message.answer("⭐ Новые участники будут записываться в этот поток.")
+    elif action == "all":
+        enrolled, _ = await db.enroll_users(challenge_id)
+        await callback.message.answer(f"🔄 В поток переведены все пользователи ({enrolled}), прогресс начат с 1 дня.")
+    elif action == "enroll":
+        await callback.message.answer(
+            "Введите ID пользователей для перевода в поток (через пробел или с новой строки) "
+            "или отправьте .txt/.csv файл со списком:",
+            reply_markup=get_cancel_keyboard()
+        )
+        await state.set_state(AdminStates.waiting_for_cohort_user_ids)
+        await state.update_data(cohort_id=challenge_id)
+    elif action == "finish":
+        await db.finish_challenge(challenge_id)
+        await callback.message.answer("🏁 Поток завершен: напоминания его участникам больше не отправляются.")
+    
+    await callback.answer()
+
+async def enroll_cohort_users(message: Message, state: FSMContext, user_ids, invalid: int):
+    if not user_ids:
+        await message.answer("Не найдено ни одного числового ID.", reply_markup=get_cancel_keyboard())
+        return
+    if len(user_ids) > BULK_STATUS_MAX_IDS:
+        await message.answer(
+            f"Слишком много ID ({len(user_ids)}), за один раз можно не больше {BULK_STATUS_MAX_IDS}.",
+            reply_markup=get_cancel_keyboard()
+        )
+        return
+    
+    data = await state.get_data()
+    enrolled, unknown = await db.enroll_users(data.get('cohort_id'), user_ids)
+    await state.clear()
+    
+    text = f"🔄 Переведено в поток: {enrolled} из {len(user_ids)}."
+    if unknown:
+        shown = ', '.join(str(user_id) for user_id in unknown[:BULK_UNKNOWN_IDS_SHOWN])
+        text += f"\nНе найдено: {len(unknown)} ({shown})"
+    if invalid:
+        text += f"\nПропущено некорректных значений: {invalid}"
+    await message.answer(text, reply_markup=get_admin_keyboard())
+
+@router.message(AdminStates.waiting_for_cohort_user_ids, F.document)
+async def process_cohort_users_file(message: Message, state: FSMContext):
+    user_ids, invalid = await read_user_ids_document(message)
+    if user_ids is not None:
+        await enroll_cohort_users(message, state, user_ids, invalid)
+
+@router.message(AdminStates.waiting_for_cohort_user_ids, F.text)
+async def process_cohort_users(message: Message, state: FSMContext):
+    user_ids, invalid = parse_user_ids(message.text)
+    await enroll_cohort_users(message, state, user_ids, invalid)
+
 # Управление пользователями
 @router.message(F.text == "🔧 Управление пользователями")
 async def manage_users(message: Message):
@@ -316,75 +594,201 @@ async def admin_management_callback(callback: CallbackQuery, state: FSMContext):
     
     if action in actions:
         text, state_name, status = actions[action]
-        await callback.message.answer(f"Введите ID пользователя для {text}:", reply_markup=get_cancel_keyboard())
+        await callback.message.answer(
+            f"Введите ID пользователя для {text}.\n"
+            f"Можно несколько ID через пробел или с новой строки, либо отправить .txt/.csv файл со списком.",
+            reply_markup=get_cancel_keyboard()
+        )
         await state.set_state(state_name)
         await state.update_data(action_status=status)
     
     await callback.answer()
 
-# Обработчики для разных действий
-@router.message(AdminStates.waiting_for_block_user_id)
-@router.message(AdminStates.waiting_for_activate_user_id)
-async def process_user_management(message: Message, state: FSMContext):
-    try:
-        user_id = int(message.text)
-        user_data = await state.get_data()
-        action_status = user_data.get('action_status', USER_ACTIVE)
-        
-        # Проверяем существование пользователя
-        user = await db.get_user(user_id)
-        if not user:
-            await message.answer("Пользователь с таким ID не найден.", reply_markup=get_admin_keyboard())
-            await state.clear()
-            return
-        
-        # Обновляем статус
-        await db.update_user_status(user_id, action_status)
-        
-        status_names = {
-            USER_BLOCKED: "заблокирован", 
-            USER_ACTIVE: "активирован (счетчик напоминаний сброшен)"
-        }
-        
+# ID пользователей из текста или файла: через пробел, запятую или с новой строки.
+# В CSV берется первая колонка, строки с нечисловым значением (заголовок) пропускаются.
+# Возвращает (уникальные ID в исходном порядке, количество некорректных значений)
+def parse_user_ids(text: str, first_column: bool = False):
+    if first_column:
+        tokens = [re.split(r'[,;\t]', line, maxsplit=1)[0].strip() for line in text.splitlines()]
+    else:
+        tokens = re.split(r'[\s,;]+', text)
+    
+    # Первая строка CSV с нечисловым значением - заголовок (например, user_id)
+    if first_column and tokens and not tokens[0].strip('"').lstrip('-').isdigit():
+        tokens = tokens[1:]
+    
+    user_ids, invalid = {}, 0
+    for token in tokens:
+        token = token.strip().strip('"')
+        if not token:
+            continue
+        if token.lstrip('-').isdigit():
+            user_ids[int(token)] = True
+        else:
+            invalid += 1
+    return list(user_ids), invalid
+
+# Список ID из присланного файла; (None, 0), если файл слишком большой
+async def read_user_ids_document(message: Message):
+    document = message.document
+    if document.file_size and document.file_size > BULK_STATUS_MAX_FILE_SIZE:
         await message.answer(
-            f"Пользователь {user_id} {status_names[action_status]}.",
-            reply_markup=get_admin_keyboard()
+            f"Файл слишком большой (больше {BULK_STATUS_MAX_FILE_SIZE // 1024} КБ).",
+            reply_markup=get_cancel_keyboard()
+        )
+        return None, 0
+    
+    content = await message.bot.download(document)
+    text = content.read().decode('utf-8-sig', errors='replace')
+    is_csv = (document.file_name or '').lower().endswith('.csv') or document.mime_type == 'text/csv'
+    return parse_user_ids(text, first_column=is_csv)
+
+async def apply_users_status(message: Message, state: FSMContext, user_ids, invalid: int):
+    if not user_ids:
+        await message.answer(
+            "Не найдено ни одного числового ID. Введите ID через пробел или отправьте .txt/.csv файл.",
+            reply_markup=get_cancel_keyboard()
+        )
+        return
+    if len(user_ids) > BULK_STATUS_MAX_IDS:
+        await message.answer(
+            f"Слишком много ID ({len(user_ids)}), за один раз можно не больше {BULK_STATUS_MAX_IDS}.",
+            reply_markup=get_cancel_keyboard()
         )
-        
-    except ValueError:
-        await message.answer("Неверный формат ID. Введите числовой ID.", reply_markup=get_cancel_keyboard())
         return
     
+    user_data = await state.get_data()
+    action_status = user_data.get('action_status', USER_ACTIVE)
+    
+    # Проверка и смена статуса всех ID - одна транзакция
+    updated, unknown = await db.update_users_status(user_ids, action_status)
     await state.clear()
+    
+    status_names = {
+        USER_BLOCKED: "заблокирован", 
+        USER_ACTIVE: "активирован (счетчик напоминаний сброшен)"
+    }
+    
+    if len(user_ids) == 1 and not invalid:
+        if unknown:
+            text = "Пользователь с таким ID не найден."
+        else:
+            text = f"Пользователь {user_ids[0]} {status_names[action_status]}."
+    else:
+        bulk_names = {USER_BLOCKED: "Заблокировано", USER_ACTIVE: "Активировано (счетчики напоминаний сброшены)"}
+        text = f"{bulk_names[action_status]}: {updated} из {len(user_ids)}."
+        unchanged = len(user_ids) - updated - len(unknown)
+        if unchanged:
+            text += f"\nУже имели этот статус: {unchanged}"
+        if unknown:
+            shown = ', '.join(str(user_id) for user_id in unknown[:BULK_UNKNOWN_IDS_SHOWN])
+            more = f" и еще {len(unknown) - BULK_UNKNOWN_IDS_SHOWN}" if len(unknown) > BULK_UNKNOWN_IDS_SHOWN else ""
+            text += f"\nНе найдено: {len(unknown)} ({shown}{more})"
+        if invalid:
+            text += f"\nПропущено некорректных значений: {invalid}"
+    
+    await message.answer(text, reply_markup=get_admin_keyboard())
 
-# Список пользователей
-@router.message(F.text == "👥 Список пользователей")
-async def list_users(message: Message):
-    if message.from_user.id not in ADMIN_IDS:
+# Обработчики для разных действий: один ID, список ID или файл со списком
+@router.message(AdminStates.waiting_for_block_user_id, F.document)
+@router.message(AdminStates.waiting_for_activate_user_id, F.document)
+async def process_user_management_file(message: Message, state: FSMContext):
+    user_ids, invalid = await read_user_ids_document(message)
+    if user_ids is not None:
+        await apply_users_status(message, state, user_ids, invalid)
+
+@router.message(AdminStates.waiting_for_block_user_id, F.text)
+@router.message(AdminStates.waiting_for_activate_user_id, F.text)
+async def process_user_management(message: Message, state: FSMContext):
+    user_ids, invalid = parse_user_ids(message.text)
+    await apply_users_status(message, state, user_ids, invalid)
+
+# Выгрузка таблиц в CSV одним документом
+@router.callback_query(F.data.in_({"export_users", "export_completions"}))
+async def export_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
         return
     
-    users = await db.get_all_users()
-    if not users:
-        await message.answer("Нет пользователей.")
+    await callback.answer("Готовлю файл...")
+    if callback.data == "export_users":
+        name, header, chunks, convert = "users", USERS_EXPORT_HEADER, db.iter_users_export(), users_export_row
+    else:
+        name, header, chunks, convert = (
+            "completions", COMPLETIONS_EXPORT_HEADER, db.iter_completions_export(), completions_export_row
+        )
+    
+    try:
+        directory, path, rows = await write_csv_export(name, header, chunks, convert)
+    except Exception as e:
+        logging.error(f"Failed to export {name}: {e}")
+        await callback.message.answer("Не удалось подготовить выгрузку.")
         return
     
+    try:
+        await callback.message.answer_document(FSInputFile(path), caption=f"📤 {name}: {rows} строк")
+    except Exception as e:
+        logging.error(f"Failed to send {name} export: {e}")
+        await callback.message.answer("Не удалось отправить файл выгрузки.")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# Список пользователей (постранично, одно сообщение редактируется при листании)
+def format_users_page(users, status):
+    title = f"Пользователи со статусом {status}" if status else "Все пользователи"
     users_list = []
     for user in users:
         status_emoji = {
             USER_ACTIVE: "✅",
-            USER_BLOCKED: "🚫"
+            USER_BLOCKED: "🚫",
+            USER_UNREACHABLE: "📵"
         }.get(user[2], "❓")
         
         users_list.append(f"{status_emoji} ID: {user[0]}, Username: @{user[1] or 'нет'}, Статус: {user[2]}, День: {user[4]}, Напоминаний: {user[3]}")
     
-    # Разбиваем на части если сообщение слишком длинное
-    message_text = "Все пользователи:\n" + "\n".join(users_list)
-    if len(message_text) > 4096:
-        parts = [message_text[i:i+4096] for i in range(0, len(message_text), 4096)]
-        for part in parts:
-            await message.answer(part)
+    return f"{title}:\n" + "\n".join(users_list)
+
+async def build_users_page(status, direction, anchor):
+    if direction == "prev":
+        users, has_prev = await db.get_users_page(before_id=anchor, status=status)
+        has_next = True
+    elif direction == "next":
+        users, has_next = await db.get_users_page(after_id=anchor, status=status)
+        has_prev = True
     else:
-        await message.answer(message_text)
+        users, has_next = await db.get_users_page(status=status)
+        has_prev = False
+    
+    if not users:
+        return "Нет пользователей.", get_users_page_keyboard(status, None, None, False, False)
+    
+    keyboard = get_users_page_keyboard(status, users[0][0], users[-1][0], has_prev, has_next)
+    return format_users_page(users, status), keyboard
+
+@router.message(F.text == "👥 Список пользователей")
+async def list_users(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    text, keyboard = await build_users_page(None, "first", None)
+    await message.answer(text, reply_markup=keyboard)
+
+@router.callback_query(F.data.startswith("users:"))
+async def users_page_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+    
+    _, status_filter, direction, anchor = callback.data.split(":")
+    status = None if status_filter == "all" else status_filter
+    text, keyboard = await build_users_page(status, direction, int(anchor))
+    
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        # Повторное нажатие того же фильтра: содержимое не изменилось
+        pass
+    await callback.answer()
 
 # Статистика
 @router.message(F.text == "📊 Статистика")
@@ -392,23 +796,19 @@ async def show_stats(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     
-    users = await db.get_all_users()
-    completed_today = await db.get_users_without_today_completion()
+    # Счетчики поддерживаются при каждой записи, запрос к users не нужен
+    stats = await db.get_stats()
     challenge_info = await db.get_challenge_info()
     
-    active_users = [u for u in users if u[2] == USER_ACTIVE]
-    blocked_users = [u for u in users if u[2] == USER_BLOCKED]
-    
-    users_with_reminders = [u for u in users if u[3] > 0]  # users with reminder_count > 0
-    
     stats_text = (
         f"📊 Статистика:\n"
-        f"👥 Всего пользователей: {len(users)}\n"
-        f"✅ Активных: {len(active_users)}\n"
-        f"🚫 Заблокированных: {len(blocked_users)}\n"
-        f"📅 Выполнили сегодня: {len(active_users) - len(completed_today)}\n"
-        f"⏰ Не выполнили сегодня: {len(completed_today)}\n"
-        f"🔔 Пользователей с напоминаниями: {len(users_with_reminders)}"
+        f"👥 Всего пользователей: {stats['total']}\n"
+        f"✅ Активных: {stats['active']}\n"
+        f"🚫 Заблокированных: {stats['blocked']}\n"
+        f"📵 Недоступных (заблокировали бота): {stats['unreachable']}, из них сегодня: {stats['unreachable_today']}\n"
+        f"📅 Выполнили сегодня: {stats['completed_today']}\n"
+        f"⏰ Не выполнили сегодня: {max(stats['active'] - stats['completed_today'], 0)}\n"
+        f"🔔 Пользователей с напоминаниями: {stats['with_reminders']}"
     )
     
     if challenge_info:
@@ -418,4 +818,15 @@ async def show_stats(message: Message):
         stats_text += f"📅 Начало: {challenge_info['start_date']}\n"
         stats_text += f"📅 Текущий день: {challenge_info['current_day']}"
     
+    # По потокам - только если их несколько; каждый запрос читает строки одного потока
+    cohorts = await db.get_active_challenges()
+    if len(cohorts) > 1:
+        stats_text += "\n\n📋 По потокам:"
+        for cohort in cohorts:
+            cohort_stats = await db.get_cohort_stats(cohort['id'])
+            stats_text += (
+                f"\n• {cohort['name']} (день {cohort['current_day']}/{cohort['total_days']}): "
+                f"{cohort_stats['active']} активных, выполнили сегодня {cohort_stats['completed_today']}"
+            )
+    
     await message.answer(stats_text)
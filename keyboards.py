@@ -34,20 +34,76 @@ def get_management_keyboard():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="🚫 Заблокировать", callback_data="admin_block")],
-            [InlineKeyboardButton(text="✅ Активировать", callback_data="admin_activate")]
+            [InlineKeyboardButton(text="✅ Активировать", callback_data="admin_activate")],
+            [InlineKeyboardButton(text="📤 Выгрузить пользователей (CSV)", callback_data="export_users")],
+            [InlineKeyboardButton(text="📤 Выгрузить выполнения (CSV)", callback_data="export_completions")]
         ]
     )
     return keyboard
 
-def get_challenge_keyboard():
+def get_challenge_keyboard(digest: bool = False):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="🆕 Создать новый челлендж", callback_data="create_challenge")],
-            [InlineKeyboardButton(text="✏️ Изменить задание", callback_data="update_task")]
+            [InlineKeyboardButton(text="✏️ Изменить задание", callback_data="update_task")],
+            [InlineKeyboardButton(text="📋 Потоки", callback_data="cohort:list:0")],
+            [InlineKeyboardButton(
+                text=f"📰 Дайджест в канале: {'вкл' if digest else 'выкл'}", callback_data="channel_digest"
+            )]
         ]
     )
     return keyboard
 
+def get_cohorts_keyboard(cohorts, default_id):
+    # По кнопке на каждый активный поток, основной отмечен звездой
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(
+                text=f"{'⭐ ' if cohort['id'] == default_id else ''}{cohort['name']}",
+                callback_data=f"cohort:show:{cohort['id']}"
+            )]
+            for cohort in cohorts
+        ]
+    )
+    return keyboard
+
+def get_cohort_keyboard(challenge_id, is_default):
+    buttons = [
+        [InlineKeyboardButton(text="👥 Перевести всех участников", callback_data=f"cohort:all:{challenge_id}")],
+        [InlineKeyboardButton(text="➕ Перевести участников по ID", callback_data=f"cohort:enroll:{challenge_id}")],
+        [InlineKeyboardButton(text="🏁 Завершить поток", callback_data=f"cohort:finish:{challenge_id}")]
+    ]
+    if not is_default:
+        buttons.insert(0, [InlineKeyboardButton(text="⭐ Сделать основным", callback_data=f"cohort:default:{challenge_id}")])
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    return keyboard
+
+def get_users_page_keyboard(status, first_id, last_id, has_prev, has_next):
+    # callback_data: users:<фильтр>:<prev|next>:<telegram_id>, фильтр "all" - все статусы
+    status_filter = status or "all"
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="◀️", callback_data=f"users:{status_filter}:prev:{first_id}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="▶️", callback_data=f"users:{status_filter}:next:{last_id}"))
+    
+    filters = [
+        [
+            InlineKeyboardButton(text="👥 Все", callback_data="users:all:first:0"),
+            InlineKeyboardButton(text="✅ Активные", callback_data="users:active:first:0")
+        ],
+        [
+            InlineKeyboardButton(text="🚫 Заблокированные", callback_data="users:blocked:first:0"),
+            InlineKeyboardButton(text="📵 Недоступные", callback_data="users:unreachable:first:0")
+        ]
+    ]
+    
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[navigation] + filters if navigation else filters
+    )
+    return keyboard
+
 def get_cancel_keyboard():
     keyboard = ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="❌ Отмена")]],
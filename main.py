@@ -1,95 +1,256 @@
 import asyncio
 import logging
+import multiprocessing
+import time
+from datetime import date
 from aiogram import Bot, Dispatcher 
 from aiogram.types import BotCommand
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import pytz
 
-from handlers import router
-from database import Database
-from constants import BOT_TOKEN, ADMIN_IDS, UPDATE_HOUR, UPDATE_MINUTE, REMINDER_TIMES
+from handlers import router, db, channel_publisher, UserActivityMiddleware
+from database import Database, JOB_EXPIRED
+from fsm_storage import SQLiteStorage
+from metrics import HandlerMetricsMiddleware, start_metrics_server
+from constants import (
+    BOT_TOKEN, ADMIN_IDS, UPDATE_HOUR, UPDATE_MINUTE, REMINDER_TIMES, USE_WEBHOOK,
+    LEADERBOARD_TIME, STATS_RECONCILE_MINUTES, WORKERS, MULTI_PROCESS, REMINDER_WINDOW_MINUTES, METRICS_PORT,
+    BROADCAST_JOURNAL_KEEP_DAYS, USER_CACHE_FLUSH_SECONDS
+)
 from keyboards import get_back_keyboard
+from broadcast import Broadcaster, BroadcastJournal
+from publisher import POST_TEXT
+from webhook import run_webhook
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def main():
+# Имя рассылки напоминаний в журнале рассылок
+REMINDERS_BROADCAST = "reminders"
+
+def get_reminder_text(challenge_info, current_count, current_day):
+    if challenge_info:
+        return (
+            f"🔔 Напоминание #{current_count}!\n"
+            f"🏆 Челлендж: {challenge_info['name']}\n"
+            f"📅 День: {current_day}/{challenge_info['total_days']}\n"
+            f"💪 Сегодня нужно сделать: {current_day} {challenge_info['task']}\n\n"
+            f"Отправь кружочек (видео-сообщение), чтобы отметить выполнение задания!\n"
+            f"Счетчик напоминаний сбросится в 00:00!"
+        )
+    return (
+        f"🔔 Напоминание #{current_count}! Не забудь выполнить ежедневный челлендж!\n"
+        f"Отправь кружочек (видео-сообщение), чтобы отметить выполнение задания!\n"
+        f"Счетчик напоминаний сбросится в 00:00!"
+    )
+
+# Минуты UTC с начала эпохи: по модулю 1440 - минута суток UTC
+def current_utc_minute():
+    return int(time.time() // 60)
+
+def due_reminder_minutes(utc_minute: int):
+    return [(utc_minute - hour * 60 - minute) % 1440 for hour, minute in REMINDER_TIMES]
+
+def get_leaderboard_text(challenge_info, leaders):
+    lines = [f"🏆 Лучшие серии челленджа '{challenge_info['name']}':"]
+    for place, (telegram_id, username, streak) in enumerate(leaders, start=1):
+        lines.append(f"{place}. @{username or 'без username'} - {streak} дн. подряд 🔥")
+    return "\n".join(lines)
+
+# worker_id - номер процесса; фоновые задачи выполняет только процесс 0
+async def main(worker_id: int = 0):
+    primary = worker_id == 0
     try:
         bot = Bot(token=BOT_TOKEN)
-        dp = Dispatcher()
-        db = Database()
+        # Состояния диалогов хранятся в БД и общие для всех процессов
+        dp = Dispatcher(storage=SQLiteStorage(db))
+        broadcaster = Broadcaster(bot)
         scheduler = AsyncIOScheduler(timezone=pytz.timezone('Europe/Moscow'))
         
-        # Инициализация БД
+        # Инициализация БД (открывает пул соединений)
         await db.init_db()
-        logging.info("Database initialized")
+        logging.info(f"Database initialized (worker {worker_id})")
         
         # Регистрация роутеров
         dp.include_router(router)
         
-        # Функция для ежедневного сброса и увеличения дня челленджа
+        # Метрики хендлеров и HTTP-сервер /metrics
+        for observer in (router.message, router.callback_query, router.chat_member):
+            observer.middleware(HandlerMetricsMiddleware())
+        
+        # Недоступный пользователь снова активен, когда пишет боту
+        for observer in (router.message, router.callback_query):
+            observer.outer_middleware(UserActivityMiddleware())
+        if METRICS_PORT:
+            # Занятый порт метрик не должен мешать запуску бота
+            try:
+                metrics_runner = await start_metrics_server(worker_id)
+            except OSError as e:
+                logging.error(f"Could not start metrics server on port {METRICS_PORT + worker_id}: {e}")
+        
+        if not primary:
+            await run_webhook(bot, dp, register=False, reuse_port=True)
+            return
+        
+        # Публикации в канал из очереди, включая оставшиеся с прошлого запуска
+        channel_publisher.start(bot)
+        
+        # Смена дня: выполнение, счетчики напоминаний и день челленджа
+        # вычисляются по дате, поэтому достаточно сбросить кэши
         async def reset_daily_tasks():
+            db.invalidate_challenge_cache()
             try:
-                await db.reset_daily_completions()
-                await db.increment_challenge_day()
-                logging.info("Daily tasks reset and challenge day incremented at 00:00")
+                removed = await db.delete_expired_fsm_states()
+                logging.info(f"Expired FSM states removed: {removed}")
             except Exception as e:
-                logging.error(f"Error in reset_daily_tasks: {e}")
+                logging.error(f"Error removing expired FSM states: {e}")
+            try:
+                reset = await db.reset_broken_streaks()
+                logging.info(f"Broken streaks reset: {reset}")
+            except Exception as e:
+                logging.error(f"Error resetting broken streaks: {e}")
+            try:
+                removed = await db.delete_old_broadcast_jobs(BROADCAST_JOURNAL_KEEP_DAYS)
+                logging.info(f"Old broadcast jobs removed: {removed}")
+            except Exception as e:
+                logging.error(f"Error removing old broadcast jobs: {e}")
+            logging.info(
+                f"New day started. Challenge cache: {db.challenge_cache_hits} hits, "
+                f"{db.challenge_cache_misses} misses"
+            )
 
-        # Функция для напоминаний (только для активных пользователей)
+        # Напоминания (только для активных пользователей): каждую минуту
+        # обрабатывается только доля пользователей, чья минута наступила
+        # data - (номер напоминания, день, поток) из журнала рассылки
+        async def send_reminder(telegram_id, data):
+            current_count, current_day, challenge_id = data
+            await bot.send_message(
+                telegram_id,
+                get_reminder_text(await db.get_challenge_info(challenge_id), current_count, current_day),
+                reply_markup=get_back_keyboard()
+            )
+        
+        # Получатели читаются пачками, а не загружаются целиком; каждая
+        # пачка сначала попадает в журнал рассылки
+        async def reminder_messages(journal):
+            async for users in db.iter_users_without_today_completion(
+                reminder_minutes=journal.params['minutes'], challenge_ids=journal.params['challenges']
+            ):
+                job_id = await journal.start()
+                for telegram_id, data in await db.add_reminder_deliveries(job_id, users):
+                    yield telegram_id, data
+        
+        # Досылка незавершенных рассылок (прерванных перезапуском или ошибкой,
+        # например занятой БД): сначала получатели без отметки в журнале, затем
+        # остаток выборки. Напоминания за прошлые дни уже неактуальны
+        async def resume_broadcasts():
+            try:
+                jobs = await db.get_unfinished_broadcast_jobs()
+            except Exception as e:
+                logging.error(f"Error reading unfinished broadcasts: {e}")
+                return
+            
+            today = date.today().toordinal()
+            for job_id, name, params, created_day in jobs:
+                try:
+                    if name != REMINDERS_BROADCAST or created_day != today:
+                        await db.finish_broadcast_job(job_id, JOB_EXPIRED)
+                        logging.info(f"Broadcast job {job_id} ({name}) expired")
+                        continue
+                    
+                    journal = BroadcastJournal(db, name, params, job_id)
+                    
+                    async def messages(journal=journal):
+                        async for deliveries in db.iter_pending_deliveries(journal.job_id):
+                            for chat_id, data in deliveries:
+                                yield chat_id, data
+                        async for item in reminder_messages(journal):
+                            yield item
+                    
+                    logging.info(f"Resuming broadcast job {job_id} ({name})")
+                    await journal.run(broadcaster, messages(), send_reminder)
+                except Exception as e:
+                    logging.error(f"Error resuming broadcast job {job_id}: {e}")
+        
         async def send_reminders():
+            # Тики не пересекаются (один экземпляр задачи), поэтому незавершенная
+            # рассылка не может выполняться сейчас и досылается здесь же
+            await resume_broadcasts()
             try:
-                users = await db.get_users_without_today_completion()
-                challenge_info = await db.get_challenge_info()
-                logging.info(f"Sending reminders to {len(users)} users")
+                # Последняя обработанная минута хранится в БД: после перезапуска
+                # или пропущенного тика догоняем пропущенные минуты (не больше окна)
+                now = current_utc_minute()
+                last = await db.get_reminder_tick()
+                if last is None:
+                    last = now - 1
+                missed = min(now - last, REMINDER_WINDOW_MINUTES)
+                if missed <= 0:
+                    return
+                minutes = [
+                    minute
+                    for utc_minute in range(now - missed + 1, now + 1)
+                    for minute in due_reminder_minutes(utc_minute)
+                ]
                 
-                for user in users:
-                    try:
-                        telegram_id, username, reminder_count, current_day = user
-                        
-                        # Увеличиваем счетчик напоминаний
-                        await db.increment_reminder_count(telegram_id)
-                        current_count = await db.get_reminder_count(telegram_id)
-                        
-                        logging.info(f"User {telegram_id} has {current_count} reminders (was {reminder_count})")
-                        
-                        # Отправляем напоминание
-                        if challenge_info:
-                            reminder_text = (
-                                f"🔔 Напоминание #{current_count}!\n"
-                                f"🏆 Челлендж: {challenge_info['name']}\n"
-                                f"📅 День: {current_day}/{challenge_info['total_days']}\n"
-                                f"💪 Сегодня нужно сделать: {current_day} {challenge_info['task']}\n\n"
-                                f"Отправь кружочек (видео-сообщение), чтобы отметить выполнение задания!\n"
-                                f"Счетчик напоминаний сбросится в 00:00!"
-                            )
-                        else:
-                            reminder_text = (
-                                f"🔔 Напоминание #{current_count}! Не забудь выполнить ежедневный челлендж!\n"
-                                f"Отправь кружочек (видео-сообщение), чтобы отметить выполнение задания!\n"
-                                f"Счетчик напоминаний сбросится в 00:00!"
-                            )
-                        
-                        await bot.send_message(
-                            telegram_id,
-                            reminder_text,
-                            reply_markup=get_back_keyboard()
-                        )
-                        logging.info(f"Reminder #{current_count} sent to user {telegram_id}")
-                        
-                    except Exception as e:
-                        logging.error(f"Failed to send reminder to {user[0]}: {e}")
+                # Напоминания только участникам начавшихся потоков
+                challenge_ids = [challenge['id'] for challenge in await db.get_running_challenges()]
+                
+                # Минута сохраняется вместе с созданием запуска в журнале; если
+                # получателей не нашлось - после выборки
+                journal = BroadcastJournal(
+                    db, REMINDERS_BROADCAST, {'minutes': minutes, 'challenges': challenge_ids}, reminder_tick=now
+                )
+                if challenge_ids:
+                    await journal.run(broadcaster, reminder_messages(journal), send_reminder)
+                if journal.job_id is None:
+                    await db.set_reminder_tick(now)
             except Exception as e:
                 logging.error(f"Error in send_reminders: {e}")
         
+        # Ежедневная таблица лидеров по сериям в канале, отдельно по каждому потоку
+        async def post_leaderboard():
+            try:
+                # Через очередь канала: с ограничением скорости и повторами
+                posts = []
+                for challenge_info in await db.get_running_challenges():
+                    leaders = await db.get_streak_leaderboard(challenge_info['id'])
+                    if leaders:
+                        posts.append((POST_TEXT, get_leaderboard_text(challenge_info, leaders)))
+                if posts:
+                    await channel_publisher.enqueue(posts)
+            except Exception as e:
+                logging.error(f"Error in post_leaderboard: {e}")
+        
+        # Периодическая сверка счетчиков статистики с таблицей users
+        async def reconcile_stats():
+            try:
+                await db.reconcile_stats()
+            except Exception as e:
+                logging.error(f"Error in reconcile_stats: {e}")
+        
+        # Отложенные изменения кэша пользователей (часовой пояс, username)
+        async def flush_users():
+            try:
+                await db.flush_users()
+            except Exception as e:
+                logging.error(f"Error in flush_users: {e}")
+        
         # Настройка расписания
         # Ежедневный сброс в 00:00
         scheduler.add_job(reset_daily_tasks, 'cron', hour=UPDATE_HOUR, minute=UPDATE_MINUTE)
         
-        # Напоминания в 7:00 и 15:00 и 19:00
-        for reminder_time in REMINDER_TIMES:
-            hour, minute = reminder_time
-            scheduler.add_job(send_reminders, 'cron', hour=hour, minute=minute)
+        # Напоминания: ежеминутный тик по слотам пользователей
+        scheduler.add_job(send_reminders, 'cron', minute='*')
+        
+        # Таблица лидеров
+        hour, minute = LEADERBOARD_TIME
+        scheduler.add_job(post_leaderboard, 'cron', hour=hour, minute=minute)
+        
+        # Сверка статистики
+        scheduler.add_job(reconcile_stats, 'interval', minutes=STATS_RECONCILE_MINUTES)
+        
+        # Запись кэша пользователей
+        scheduler.add_job(flush_users, 'interval', seconds=USER_CACHE_FLUSH_SECONDS)
         
         # Запуск планировщика
         scheduler.start()
@@ -98,6 +259,8 @@ async def main():
         # Установка команд бота
         await bot.set_my_commands([
             BotCommand(command="start", description="Начать работу с ботом"),
+            BotCommand(command="streak", description="Моя серия и пропущенные дни"),
+            BotCommand(command="timezone", description="Часовой пояс для напоминаний"),
             BotCommand(command="admin", description="Админ панель")
         ])
         
@@ -110,15 +273,63 @@ async def main():
         logging.info("Bot started successfully")
         
         # Запуск бота
-        await dp.start_polling(bot)
+        if USE_WEBHOOK:
+            await run_webhook(bot, dp, reuse_port=MULTI_PROCESS)
+        else:
+            # resolve_used_update_types включает chat_member для кэша подписок
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
         
     except Exception as e:
         logging.error(f"Failed to start bot: {e}")
     finally:
-        if 'scheduler' in locals():
+        if 'scheduler' in locals() and scheduler.running:
             scheduler.shutdown()
+        if 'broadcaster' in locals():
+            await broadcaster.shutdown()
+        await channel_publisher.stop()
+        if 'metrics_runner' in locals():
+            await metrics_runner.cleanup()
+        await db.close()
         if 'bot' in locals():
             await bot.session.close()
 
+def run_worker(worker_id: int):
+    try:
+        asyncio.run(main(worker_id))
+    except KeyboardInterrupt:
+        pass
+
+# Миграции выполняются один раз до запуска процессов
+async def prepare_database():
+    database = Database()
+    await database.init_db()
+    await database.close()
+
+def run_workers():
+    asyncio.run(prepare_database())
+    
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(worker_id,), name=f"worker-{worker_id}")
+        for worker_id in range(WORKERS)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Started {WORKERS} workers")
+    
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if MULTI_PROCESS:
+        run_workers()
+    else:
+        if WORKERS > 1:
+            # Long polling не может делиться между процессами (getUpdates конфликтует)
+            logging.warning("WORKERS > 1 requires USE_WEBHOOK, starting a single process")
+        asyncio.run(main())
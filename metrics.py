@@ -0,0 +1,263 @@
+import contextvars
+import functools
+import inspect
+import logging
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+from constants import METRICS_HOST, METRICS_PORT
+
+# Границы корзин гистограмм задержки (сек)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+# Метрики хранятся в памяти процесса и отдаются в текстовом формате Prometheus
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, labels=(), value: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [счетчики по корзинам, сумма, количество]
+        self._values = {}
+
+    def observe(self, labels=(), value: float = 0):
+        item = self._values.get(labels)
+        if item is None:
+            item = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                item[0][i] += 1
+                break
+        item[1] += value
+        item[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', _format_labels(self.labels, labels, [('le', bound)]), cumulative
+            yield self.name + '_bucket', _format_labels(self.labels, labels, [('le', '+Inf')]), count
+            yield self.name + '_sum', _format_labels(self.labels, labels), total
+            yield self.name + '_count', _format_labels(self.labels, labels), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_latency = registry.register(Histogram(
+    'bot_handler_duration_seconds', 'Время обработки обновления хендлером', ('handler',)
+))
+handler_errors = registry.register(Counter(
+    'bot_handler_errors_total', 'Исключения в хендлерах', ('handler',)
+))
+db_latency = registry.register(Histogram(
+    'bot_db_query_duration_seconds', 'Время выполнения методов Database', ('method',)
+))
+db_rows = registry.register(Counter(
+    'bot_db_rows_total', 'Строки, прочитанные или измененные методами Database', ('method',)
+))
+db_errors = registry.register(Counter(
+    'bot_db_errors_total', 'Исключения в методах Database', ('method',)
+))
+db_cache_hits = registry.register(Counter(
+    'bot_db_cache_hits_total', 'Вызовы методов Database, обслуженные из кэша без запроса к БД', ('method',)
+))
+broadcast_messages = registry.register(Counter(
+    'bot_broadcast_messages_total', 'Сообщения рассылок по результату', ('broadcast', 'result')
+))
+broadcast_duration = registry.register(Histogram(
+    'bot_broadcast_duration_seconds', 'Длительность рассылок', ('broadcast',),
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+))
+
+
+# Задержка и ошибки по хендлерам router; регистрируется как inner-middleware,
+# поэтому вызывается только для обновлений, которые нашли хендлер
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc((name,))
+            raise
+        finally:
+            handler_latency.observe((name,), time.perf_counter() - started)
+
+
+# Обращения текущего вызова метода Database к БД: [изменено строк, была ли
+# запись, было ли обращение к пулу]. ConnectionPool отмечает каждое чтение и
+# запись, а после коммита добавляет число измененных строк
+_rows_touched = contextvars.ContextVar('rows_touched', default=None)
+
+
+def record_db_access():
+    touched = _rows_touched.get()
+    if touched is not None:
+        touched[2] = True
+
+
+def record_rows_touched(count: int):
+    touched = _rows_touched.get()
+    if touched is not None:
+        touched[0] += count
+        touched[1] = True
+
+
+def count_rows(result, touched=(0, False, True)):
+    # Если метод писал в БД - строки, измененные его транзакциями (число в
+    # результате может быть id или днем, а не количеством); для чтения -
+    # строки в результате: список, пара (страница, есть ли еще) или одна
+    # строка (в том числе словарь, собранный из одной строки)
+    count, wrote, _ = touched
+    if wrote:
+        return count
+    # 0 без записи - метод ничего не сделал (например, нечего сбрасывать)
+    if result is None or isinstance(result, bool) or result == 0:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])
+    return 1
+
+
+def _instrument_coroutine(name, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        parent = _rows_touched.get()
+        touched = [0, False, False]
+        token = _rows_touched.set(touched)
+        try:
+            result = await method(*args, **kwargs)
+        except Exception:
+            db_errors.inc((name,))
+            raise
+        finally:
+            _rows_touched.reset(token)
+            # Обращения вложенного метода входят и в счетчик вызвавшего
+            if parent is not None:
+                if touched[1]:
+                    parent[0] += touched[0]
+                    parent[1] = True
+                parent[2] = parent[2] or touched[2]
+            # Ответ из кэша считается отдельно, чтобы не искажать задержку БД
+            if touched[2]:
+                db_latency.observe((name,), time.perf_counter() - started)
+            else:
+                db_cache_hits.inc((name,))
+        if touched[2]:
+            db_rows.inc((name,), count_rows(result, touched))
+        return result
+    return wrapper
+
+
+def _instrument_generator(name, method):
+    # Для генераторов пачек время считается до последней пачки. Внутренний
+    # генератор закрывается явно, чтобы сразу вернуть соединение в пул
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        chunks = method(*args, **kwargs)
+        try:
+            async for chunk in chunks:
+                db_rows.inc((name,), len(chunk))
+                yield chunk
+        except Exception:
+            db_errors.inc((name,))
+            raise
+        finally:
+            await chunks.aclose()
+            db_latency.observe((name,), time.perf_counter() - started)
+    return wrapper
+
+
+# Оборачивает все публичные асинхронные методы класса
+def instrument_class(cls):
+    for name, method in list(vars(cls).items()):
+        if name.startswith('_'):
+            continue
+        if inspect.isasyncgenfunction(method):
+            setattr(cls, name, _instrument_generator(name, method))
+        elif inspect.iscoroutinefunction(method):
+            setattr(cls, name, _instrument_coroutine(name, method))
+    return cls
+
+
+async def metrics_handler(request):
+    return web.Response(
+        text=registry.render(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+
+# Отдельный HTTP-сервер для /metrics, по умолчанию только на localhost.
+# У каждого процесса свои метрики и свой порт: METRICS_PORT + номер процесса
+async def start_metrics_server(worker_id: int = 0):
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = METRICS_PORT + worker_id
+    site = web.TCPSite(runner, METRICS_HOST, port)
+    try:
+        await site.start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    logging.info(f"Metrics available at http://{METRICS_HOST}:{port}/metrics")
+    return runner
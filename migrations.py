@@ -0,0 +1,374 @@
+import logging
+from datetime import date
+
+from constants import USER_ACTIVE, DEFAULT_TZ_OFFSET, REMINDER_WINDOW_MINUTES
+
+# Разница между julianday() в SQLite и date.toordinal() в Python
+JULIAN_DAY_OFFSET = 1721424.5
+
+
+# 1: исходная схема (таблицы, созданные до появления миграций)
+async def initial_schema(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            status TEXT DEFAULT 'active',
+            last_completion_date DATE,
+            reminder_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            start_date DATE,
+            current_day INTEGER DEFAULT 0
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS admin_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS challenge_progress (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            challenge_name TEXT,
+            challenge_task TEXT,
+            total_days INTEGER,
+            start_date DATE,
+            current_day INTEGER DEFAULT 1,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+    ''')
+
+
+# 2: даты хранятся как номера дней (date.toordinal()), индексы под напоминания и статистику
+async def day_ordinals_and_indexes(db):
+    await db.execute('''
+        CREATE TABLE users_new (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            status TEXT DEFAULT 'active',
+            last_completion_day INTEGER,
+            reminder_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            start_day INTEGER,
+            current_day INTEGER DEFAULT 0
+        )
+    ''')
+    await db.execute(f'''
+        INSERT INTO users_new
+        SELECT telegram_id, username, status,
+            CAST(julianday(last_completion_date) - {JULIAN_DAY_OFFSET} AS INTEGER),
+            reminder_count, created_at,
+            CAST(julianday(start_date) - {JULIAN_DAY_OFFSET} AS INTEGER),
+            current_day
+        FROM users
+    ''')
+    await db.execute('DROP TABLE users')
+    await db.execute('ALTER TABLE users_new RENAME TO users')
+
+    await db.execute('''
+        CREATE TABLE challenge_progress_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            challenge_name TEXT,
+            challenge_task TEXT,
+            total_days INTEGER,
+            start_day INTEGER,
+            current_day INTEGER DEFAULT 1,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+    ''')
+    await db.execute(f'''
+        INSERT INTO challenge_progress_new
+        SELECT id, challenge_name, challenge_task, total_days,
+            CAST(julianday(start_date) - {JULIAN_DAY_OFFSET} AS INTEGER),
+            current_day, is_active
+        FROM challenge_progress
+    ''')
+    await db.execute('DROP TABLE challenge_progress')
+    await db.execute('ALTER TABLE challenge_progress_new RENAME TO challenge_progress')
+
+    # Частичный индекс: напоминания ищут только активных пользователей.
+    # IFNULL вместо условия с OR IS NULL, иначе индекс не используется
+    await db.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_users_active_completion
+        ON users (IFNULL(last_completion_day, 0)) WHERE status = '{USER_ACTIVE}'
+    ''')
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_challenge_progress_active ON challenge_progress (is_active, id)'
+    )
+
+
+# 3: счетчик напоминаний привязан к дню, к которому он относится
+async def day_scoped_reminders(db):
+    if not await column_exists(db, 'users', 'reminder_day'):
+        await db.execute('ALTER TABLE users ADD COLUMN reminder_day INTEGER')
+        # До миграции счетчик обнулялся в полночь, значит ненулевой - сегодняшний
+        await db.execute(
+            'UPDATE users SET reminder_day = ? WHERE reminder_count > 0',
+            (date.today().toordinal(),)
+        )
+
+
+# 4: история выполнений (только добавление) для серий и таблицы лидеров
+async def completions_history(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS completions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            challenge_id INTEGER,
+            day_number INTEGER,
+            completion_day INTEGER NOT NULL,
+            file_unique_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Серия и пропуски одного пользователя; заодно не дает записать день дважды
+    await db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_completions_user_day
+        ON completions (telegram_id, challenge_id, completion_day)
+    ''')
+    # Таблица лидеров по челленджу
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_completions_challenge_user
+        ON completions (challenge_id, telegram_id, completion_day)
+    ''')
+    # До истории хранился только последний день выполнения - он и становится
+    # первой записью, чтобы серии не начинались с нуля
+    await db.execute('''
+        INSERT OR IGNORE INTO completions (telegram_id, challenge_id, day_number, completion_day)
+        SELECT u.telegram_id, c.id,
+            CASE WHEN u.start_day IS NOT NULL THEN u.last_completion_day - u.start_day + 1 END,
+            u.last_completion_day
+        FROM users u, (
+            SELECT id FROM challenge_progress WHERE is_active = TRUE ORDER BY id DESC LIMIT 1
+        ) c
+        WHERE u.last_completion_day IS NOT NULL
+    ''')
+
+
+# 5: счетчики для панели статистики (день 0 - общие, иначе номер дня)
+async def stats_counters(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT NOT NULL,
+            day INTEGER NOT NULL DEFAULT 0,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, day)
+        )
+    ''')
+
+
+# 6: постраничный список пользователей с фильтром по статусу
+async def users_status_index(db):
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_status_id ON users (status, telegram_id)')
+
+
+# 7: очередь публикаций в канал (payload - file_id кружочка или текст)
+async def channel_queue(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS channel_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_channel_queue_status ON channel_queue (status, id)')
+
+
+# 8: состояния FSM (диалоги админки), общие для всех процессов бота
+async def fsm_states(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at)')
+
+
+# 9: часовой пояс пользователя и минута напоминания (UTC, относительно
+# времени из REMINDER_TIMES); формула совпадает с database.reminder_minute
+async def reminder_slots(db):
+    if not await column_exists(db, 'users', 'tz_offset'):
+        await db.execute(f'ALTER TABLE users ADD COLUMN tz_offset INTEGER NOT NULL DEFAULT {DEFAULT_TZ_OFFSET}')
+    if not await column_exists(db, 'users', 'reminder_minute'):
+        await db.execute('ALTER TABLE users ADD COLUMN reminder_minute INTEGER NOT NULL DEFAULT 0')
+    await db.execute(
+        'UPDATE users SET reminder_minute = (telegram_id % ? - tz_offset + 1440) % 1440',
+        (REMINDER_WINDOW_MINUTES,)
+    )
+    await db.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_users_reminder_minute
+        ON users (reminder_minute) WHERE status = '{USER_ACTIVE}'
+    ''')
+
+
+# 10: потоки - несколько челленджей одновременно. users.challenge_id - текущий
+# поток пользователя, challenge_enrollments - история записей в потоки
+async def cohorts(db):
+    if not await column_exists(db, 'users', 'challenge_id'):
+        await db.execute('ALTER TABLE users ADD COLUMN challenge_id INTEGER')
+        await db.execute('''
+            UPDATE users SET challenge_id = (
+                SELECT id FROM challenge_progress WHERE is_active = TRUE ORDER BY id DESC LIMIT 1
+            )
+        ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS challenge_enrollments (
+            challenge_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            start_day INTEGER,
+            enrolled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (challenge_id, telegram_id)
+        )
+    ''')
+    await db.execute('''
+        INSERT OR IGNORE INTO challenge_enrollments (challenge_id, telegram_id, start_day)
+        SELECT challenge_id, telegram_id, start_day FROM users WHERE challenge_id IS NOT NULL
+    ''')
+    # Статистика потока: число участников по статусам и выполнивших сегодня
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_users_cohort_status ON users (challenge_id, status, last_completion_day)'
+    )
+    # Напоминания: пользователи идущих потоков, чья минута наступила
+    await db.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_users_cohort_reminder
+        ON users (challenge_id, reminder_minute) WHERE status = '{USER_ACTIVE}'
+    ''')
+    await db.execute('DROP INDEX IF EXISTS idx_users_reminder_minute')
+
+
+# 11: журнал рассылок: запуск с параметрами выборки получателей и получатели
+# со статусом доставки (pending/sent/failed), чтобы после перезапуска дослать остаток
+async def broadcast_journal(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            params TEXT,
+            created_day INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status, id)')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            data TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (job_id, chat_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+# 12: день, когда пользователь стал недоступен (статистика "стали недоступны сегодня")
+async def unreachable_users(db):
+    if not await column_exists(db, 'users', 'unreachable_day'):
+        await db.execute('ALTER TABLE users ADD COLUMN unreachable_day INTEGER')
+
+
+
+# 13: текущая серия участника потока: обновляется при выполнении, чтобы
+# таблица лидеров по сериям читала верх индекса, а не всю историю
+async def enrollment_streaks(db):
+    if not await column_exists(db, 'challenge_enrollments', 'current_streak'):
+        await db.execute('ALTER TABLE challenge_enrollments ADD COLUMN current_streak INTEGER NOT NULL DEFAULT 0')
+    if not await column_exists(db, 'challenge_enrollments', 'last_day'):
+        await db.execute('ALTER TABLE challenge_enrollments ADD COLUMN last_day INTEGER')
+    # Последняя серия подряд идущих дней по истории выполнений
+    await db.execute('''
+        WITH days AS (
+            SELECT challenge_id, telegram_id, completion_day,
+                completion_day - ROW_NUMBER() OVER (
+                    PARTITION BY challenge_id, telegram_id ORDER BY completion_day
+                ) AS grp
+            FROM completions
+            WHERE challenge_id IS NOT NULL
+        ),
+        runs AS (
+            SELECT challenge_id, telegram_id, COUNT(*) AS streak, MAX(completion_day) AS last_day
+            FROM days GROUP BY challenge_id, telegram_id, grp
+        )
+        UPDATE challenge_enrollments SET current_streak = r.streak, last_day = r.last_day
+        FROM (
+            SELECT challenge_id, telegram_id, streak, MAX(last_day) AS last_day
+            FROM runs GROUP BY challenge_id, telegram_id
+        ) AS r
+        WHERE challenge_enrollments.challenge_id = r.challenge_id
+        AND challenge_enrollments.telegram_id = r.telegram_id
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_enrollments_streak
+        ON challenge_enrollments (challenge_id, current_streak DESC, telegram_id)
+    ''')
+    # Сброс прерванных серий в полночь: только строки с ненулевой серией
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_enrollments_streak_day
+        ON challenge_enrollments (last_day) WHERE current_streak > 0
+    ''')
+
+
+# Порядок важен: новые миграции добавляются только в конец
+MIGRATIONS = [
+    (1, 'initial schema', initial_schema),
+    (2, 'day ordinals and indexes', day_ordinals_and_indexes),
+    (3, 'day-scoped reminder counts', day_scoped_reminders),
+    (4, 'completions history', completions_history),
+    (5, 'stats counters', stats_counters),
+    (6, 'users status index', users_status_index),
+    (7, 'channel queue', channel_queue),
+    (8, 'fsm states', fsm_states),
+    (9, 'reminder slots', reminder_slots),
+    (10, 'cohorts', cohorts),
+    (11, 'broadcast journal', broadcast_journal),
+    (12, 'unreachable users', unreachable_users),
+    (13, 'enrollment streaks', enrollment_streaks),
+]
+
+
+async def column_exists(db, table: str, column: str):
+    async with db.execute(f'PRAGMA table_info({table})') as cursor:
+        return any(row[1] == column for row in await cursor.fetchall())
+
+
+async def get_schema_version(db):
+    async with db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+
+# Применяет недостающие миграции, каждую в своей транзакции
+async def apply_migrations(pool):
+    async with pool.write() as db:
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    for version, name, migrate in MIGRATIONS:
+        async with pool.write() as db:
+            # Версия проверяется внутри транзакции: если миграцию уже
+            # применил другой процесс, она пропускается
+            if version <= await get_schema_version(db):
+                continue
+
+            await migrate(db)
+            await db.execute(
+                'INSERT INTO schema_version (version, name) VALUES (?, ?)',
+                (version, name)
+            )
+        logging.info(f"Applied database migration {version}: {name}")
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramForbiddenError, TelegramBadRequest
+)
+
+from broadcast import TokenBucket
+from metrics import broadcast_messages
+from constants import (
+    CHANNEL_ID, CHANNEL_POSTS_PER_MINUTE, CHANNEL_QUEUE_MAX_ATTEMPTS, CHANNEL_QUEUE_MAX_DELAY, CHANNEL_QUEUE_POLL_INTERVAL,
+    CHANNEL_DIGEST_INTERVAL_MINUTES, CHANNEL_DIGEST_MAX_COMPLETIONS, MESSAGE_MAX_LENGTH
+)
+
+# Виды публикаций в очереди канала
+POST_VIDEO_NOTE = "video_note"
+POST_TEXT = "text"
+# Ждут сводки дайджеста: строка о выполнении и отложенный кружочек
+POST_DIGEST_LINE = "digest_line"
+POST_DIGEST_VIDEO_NOTE = "digest_video_note"
+DIGEST_KINDS = (POST_DIGEST_LINE, POST_DIGEST_VIDEO_NOTE)
+
+DIGEST_HEADER = "📣 Выполнили задание:"
+
+
+# Строки дайджеста, разбитые на сообщения не длиннее MESSAGE_MAX_LENGTH
+def split_digest(lines, header: str = DIGEST_HEADER, limit: int = MESSAGE_MAX_LENGTH):
+    messages, current = [], header
+    for line in lines:
+        line = line[:limit - len(header) - 1]
+        if len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = header
+        current += "\n" + line
+    if current != header:
+        messages.append(current)
+    return messages
+
+
+# Сводка дайджеста как обычные публикации: сначала отложенные кружочки
+# по порядку, затем текст одним или несколькими сообщениями
+def build_digest_posts(entries):
+    video_notes = [(POST_VIDEO_NOTE, payload) for kind, payload in entries if kind == POST_DIGEST_VIDEO_NOTE]
+    lines = [payload for kind, payload in entries if kind == POST_DIGEST_LINE]
+    return video_notes + [(POST_TEXT, text) for text in split_digest(lines)]
+
+
+# Фоновая публикация в канал из очереди channel_queue: по порядку,
+# с ограничением скорости и повторами с растущей задержкой.
+# Публикации дайджеста копятся в очереди и сворачиваются в сводку, когда
+# их набралось max_completions, самой старой больше digest_interval секунд
+# или режим дайджеста выключен
+class ChannelPublisher:
+    # Сколько публикаций читать из очереди за раз
+    BATCH_SIZE = 20
+
+    def __init__(
+        self,
+        db,
+        posts_per_minute: float = CHANNEL_POSTS_PER_MINUTE,
+        digest_interval: float = CHANNEL_DIGEST_INTERVAL_MINUTES * 60,
+        max_completions: int = CHANNEL_DIGEST_MAX_COMPLETIONS
+    ):
+        self.db = db
+        self.bot = None
+        self.digest_interval = digest_interval
+        self.max_completions = max_completions
+        self.bucket = TokenBucket(posts_per_minute / 60, capacity=1)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self):
+        # В очереди появились новые публикации
+        self._wakeup.set()
+
+    async def enqueue(self, posts):
+        # posts - список (вид, file_id или текст); публикуются в этом порядке
+        await self.db.enqueue_channel_posts(posts)
+        self.notify()
+
+    async def _wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _check_digest(self):
+        # Сворачивает дайджест, если пора; возвращает, через сколько секунд проверить снова
+        completions, oldest = await self.db.get_channel_digest_state(DIGEST_KINDS, POST_DIGEST_LINE)
+        if oldest is None:
+            return CHANNEL_QUEUE_POLL_INTERVAL
+        
+        due_in = oldest + self.digest_interval - time.time()
+        if due_in > 0 and completions < self.max_completions and await self.db.get_channel_digest_mode():
+            return min(due_in, CHANNEL_QUEUE_POLL_INTERVAL)
+        
+        collapsed = await self.db.collapse_channel_digest(DIGEST_KINDS, build_digest_posts)
+        logging.info(f"Channel digest: {completions} completions, {collapsed} queued posts collapsed")
+        return CHANNEL_QUEUE_POLL_INTERVAL
+
+    async def _run(self):
+        while True:
+            try:
+                timeout = await self._check_digest()
+                posts = await self.db.get_channel_queue_head(self.BATCH_SIZE, exclude_kinds=DIGEST_KINDS)
+            except Exception as e:
+                logging.error(f"Failed to read channel queue: {e}")
+                await self._wait(CHANNEL_QUEUE_POLL_INTERVAL)
+                continue
+
+            if not posts:
+                await self._wait(timeout)
+                continue
+
+            # Ошибка записи в очередь (например, БД занята другим процессом)
+            # не должна останавливать фоновую публикацию
+            try:
+                for post in posts:
+                    if not await self._process(post):
+                        break
+            except Exception as e:
+                logging.error(f"Failed to update channel queue: {e}")
+                await self._wait(CHANNEL_QUEUE_POLL_INTERVAL)
+
+    async def _process(self, post):
+        # Возвращает False, если очередь нужно перечитать с начала
+        post_id, kind, payload, attempts, next_attempt_at = post
+        delay = next_attempt_at - time.time()
+        if delay > 0:
+            # Порядок важен: ждем, пока не подойдет время повтора первой публикации
+            await self._wait(delay)
+            return False
+
+        await self.bucket.acquire()
+        try:
+            await self._publish(kind, payload)
+        except TelegramRetryAfter as e:
+            logging.warning(f"Flood control on channel, retry after {e.retry_after}s")
+            self.bucket.pause(e.retry_after)
+            return False
+        except Exception as e:
+            attempts += 1
+            if isinstance(e, (TelegramNetworkError, TelegramServerError)):
+                # Сбой сети или Telegram: публикация ждет, сколько бы он ни длился
+                failed = False
+            elif isinstance(e, (TelegramBadRequest, TelegramForbiddenError)):
+                # Повтор не поможет (неверный запрос, нет прав в канале)
+                failed = True
+            else:
+                failed = attempts >= CHANNEL_QUEUE_MAX_ATTEMPTS
+            delay = min(2 ** min(attempts, 16), CHANNEL_QUEUE_MAX_DELAY)
+            await self.db.reschedule_channel_post(post_id, attempts, time.time() + delay, failed)
+            broadcast_messages.inc(('channel', 'failed' if failed else 'retried'))
+            if failed:
+                logging.error(f"Giving up on channel post {post_id} after {attempts} attempts: {e}")
+                return True
+            logging.warning(f"Failed to publish channel post {post_id} (attempt {attempts}): {e}")
+            return False
+
+        await self.db.delete_channel_post(post_id)
+        broadcast_messages.inc(('channel', 'sent'))
+        return True
+
+    async def _publish(self, kind, payload):
+        if kind == POST_VIDEO_NOTE:
+            await self.bot.send_video_note(CHANNEL_ID, payload)
+        else:
+            await self.bot.send_message(CHANNEL_ID, payload)
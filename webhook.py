@@ -0,0 +1,57 @@
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from constants import (
+    WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEB_SERVER_HOST, WEB_SERVER_PORT
+)
+
+
+def create_app(bot, dp):
+    app = web.Application()
+    # Запросы без правильного X-Telegram-Bot-Api-Secret-Token отклоняются
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    # Связывает startup/shutdown диспетчера с жизненным циклом приложения
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+# register - регистрировать ли webhook в Telegram (только в первом процессе),
+# reuse_port позволяет нескольким процессам слушать один порт
+async def run_webhook(bot, dp, register=True, reuse_port=False):
+    app = create_app(bot, dp)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT, reuse_port=reuse_port or None)
+    await site.start()
+    logging.info(f"Webhook server listening on {WEB_SERVER_HOST}:{WEB_SERVER_PORT}{WEBHOOK_PATH}")
+
+    # Без WEBHOOK_BASE_URL webhook не регистрируется в Telegram:
+    # так сервер можно проверять локально, отправляя сохраненные обновления POST-запросом
+    register = register and bool(WEBHOOK_BASE_URL)
+    if register:
+        if not WEBHOOK_SECRET:
+            logging.warning("WEBHOOK_SECRET is empty, webhook requests are not authenticated")
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logging.info("Webhook registered")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if register:
+            try:
+                await bot.delete_webhook()
+                logging.info("Webhook removed")
+            except Exception as e:
+                logging.warning(f"Could not remove webhook: {e}")
+        await runner.cleanup()